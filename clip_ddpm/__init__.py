@@ -0,0 +1,16 @@
+'''
+CLIP-DiffusionLM: image captioning with a diffusion language model conditioned on CLIP features
+
+modules are imported on demand, importing the package itself loads nothing:
+  config      RunConfig, typed run configuration passed to the modules below
+  data        dataset, tokenizer and loaders
+  feature_store  memory-mapped CLIP features, converted from the pickles with python -m clip_ddpm store
+  shards      sharded caption datasets streamed from disk
+  splits      train / validation split manifests
+  model       DistilBertModel denoiser and checkpoint loading
+  diffusion   forward diffusion and training loss
+  optimizer   AdamW param groups, fused and flat buffer variants
+  ema         exponential moving average of trainable parameters
+  sampling    caption sampling, inference graphs and rounding
+  train, evaluate, compare, caption, extract, pack    command modules, run with python -m clip_ddpm
+'''
@@ -0,0 +1,76 @@
+'''
+usage: python -m clip_ddpm {train,eval,compare,sample,extract,pack,store,startup} [args]
+
+  train    train a model, see RunConfig in clip_ddpm/config.py for the configuration
+  eval     BLEU-4 and reports of a trained checkpoint on its validation split
+  compare  comparison table of BLEU-4, latency and memory of several checkpoints
+  sample   caption image files
+  extract  CLIP features of a caption file and its images
+  pack     sharded dataset of caption files and CLIP features, streamed by train --shard-dir
+  store    memory-mapped CLIP feature store of the feature pickles, read by train --feature-store
+  startup  startup time benchmark of the commands above
+
+train, eval, compare, sample, extract, pack and store take --config RUN.json and --field-name VALUE options of RunConfig fields
+only the module of the chosen command is imported, heavy libraries are imported where they are first used
+'''
+
+import argparse
+import importlib
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = {
+  "train": "clip_ddpm.train",
+  "eval": "clip_ddpm.evaluate",
+  "compare": "clip_ddpm.compare",
+  "sample": "clip_ddpm.caption",
+  "extract": "clip_ddpm.extract",
+  "pack": "clip_ddpm.pack",
+  "store": "clip_ddpm.feature_store",
+}
+
+# libraries a command should only pay for when it uses them
+HEAVY_MODULES = ["transformers", "spacy", "torchmetrics", "onnxruntime", "faiss", "GPUtil", "PIL"]
+
+def benchmark_startup(repeat=5):
+  '''
+  print median wall time of `python -m clip_ddpm <command> --help` in a fresh interpreter for each command,
+  against a bare `import torch` floor, and the heavy libraries each command module imports
+  '''
+  runs = {"import torch": [sys.executable, "-c", "import torch"]}
+  runs.update({command: [sys.executable, "-m", "clip_ddpm", command, "--help"] for command in COMMANDS})
+  for name, cmd in runs.items():
+    times = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+      times.append(time.perf_counter() - start)
+    line = f"{name}: {statistics.median(times) * 1000:.0f} ms"
+    if name in COMMANDS:
+      # modules print at import (get_device), only what follows the sentinel of the last line is the module list
+      probe = f"import sys, {COMMANDS[name]}; print('heavy imports:', *(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+      stdout = subprocess.run([sys.executable, "-c", probe], check=True, capture_output=True, text=True).stdout
+      imported = stdout.rpartition("heavy imports:")[2].split()
+      line += f", heavy imports: {imported or 'none'}"
+    print(line)
+
+def main(argv=None):
+  argv = sys.argv[1:] if argv is None else argv
+  if len(argv) == 0 or argv[0] in ["-h", "--help"]:
+    print(__doc__.strip())
+    return
+  command, args = argv[0], argv[1:]
+  if command == "startup":
+    parser = argparse.ArgumentParser(prog="python -m clip_ddpm startup", description="startup time benchmark of the commands")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per command, the median is reported")
+    benchmark_startup(parser.parse_args(args).repeat)
+  elif command in COMMANDS:
+    importlib.import_module(COMMANDS[command]).main(args)
+  else:
+    print(__doc__.strip(), file=sys.stderr)
+    sys.exit(2)
+
+if __name__ == "__main__":
+  main()
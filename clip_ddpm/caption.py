@@ -0,0 +1,39 @@
+'''
+sample command: caption image files with a trained checkpoint, CLIP image features are extracted on the fly
+'''
+
+import argparse
+
+import torch
+
+from . import data
+from .config import add_config_arguments, config_from_args
+from .extract import image_features
+from .model import load_checkpoint
+from .sampling import make_denoise_step, sample, to_vocab_ids
+
+def caption_images(config, model, tokenizer, images, steps=None):
+  '''
+  return one sampled caption string per PIL image, steps defaults to config.sample_steps
+  '''
+  image_clip = image_features(config, images).unsqueeze(1)
+  step = make_denoise_step(model, config.inference_graph, onnx_path=config.resolved_onnx_path())
+  with torch.no_grad():
+    out, _ = sample(config, step, image_clip, config.sample_steps if steps is None else steps)
+  indexes = to_vocab_ids(model, out.argmax(dim=-1))
+  return [tokenizer.decode(index.unique_consecutive()) for index in indexes]
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m clip_ddpm sample", description=__doc__.strip())
+  parser.add_argument("images", nargs="+", help="image files")
+  parser.add_argument("--checkpoint", default=None, help="pickled model, default {model_name}.pickle in output_dir")
+  add_config_arguments(parser)
+  args = parser.parse_args(argv)
+  config = config_from_args(args)
+
+  from PIL import Image
+
+  model = load_checkpoint(config, args.checkpoint, ema=config.use_ema).eval()
+  captions = caption_images(config, model, data.load_tokenizer(config), [Image.open(path).convert("RGB") for path in args.images])
+  for path, caption in zip(args.images, captions):
+    print(f"{path}: {caption}")
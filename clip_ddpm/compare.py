@@ -0,0 +1,138 @@
+'''
+compare command: BLEU-4, per-step latency and memory of several checkpoints on one validation split, written as one table.
+Dataset, CLIP features, references, tokenizer and reranking CLIP are loaded once per process and shared by the checkpoints,
+which are evaluated sequentially or on a pool of worker processes
+'''
+
+import argparse
+import concurrent.futures
+import functools
+import glob
+import multiprocessing
+import os
+import resource
+import sys
+
+import torch
+
+from . import data
+from .config import add_config_arguments, config_from_args
+from .evaluate import evaluate_bleu, image_loader, nearest_embedding_indexes, reference_captions
+from .model import load_checkpoint
+from .sampling import ClipCaptionScorer, benchmark_denoise_step, make_denoise_step
+from .utils import get_device
+
+device = get_device()
+
+# RunConfig fields taken from the command line config for every checkpoint, the others (model structure) come from the checkpoint
+SHARED_FIELDS = [
+  "batch_size", "sources", "vocab_captions", "vocab_min_count", "deduplicate_image_features", "feature_store",
+  "tokenizer_path", "distilbert_path", "clip_processor_path", "clip_path", "output_dir",
+  "sample_steps", "early_exit", "early_exit_patience", "early_exit_tolerance", "evaluate_per_image", "candidate_num",
+  "clamp_method", "rounding_method", "ivfpq_nprobe", "inference_graph",
+]
+
+def expand_checkpoints(patterns):
+  '''
+  checkpoint paths of file names and glob patterns, in order without duplicates
+  '''
+  paths = []
+  for pattern in patterns:
+    paths.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+  return list(dict.fromkeys(paths))
+
+def checkpoint_config(config, model):
+  '''
+  run config of model with the data, sampling and inference graph fields of config
+  '''
+  return model.run_config.replace(**{name: getattr(config, name) for name in SHARED_FIELDS})
+
+@functools.lru_cache(maxsize=None)
+def shared_data(config, valset=None):
+  '''
+  return (loader, references, scorer) shared by every checkpoint evaluated with config in this process
+  '''
+  dataset = data.load_dataset(config)
+  val_set = data.load_val_set(config, dataset, valset)
+  loader = image_loader(config, dataset, val_set) if config.evaluate_per_image else data.make_loader(config, dataset, val_set, shuffle=False)
+  scorer = ClipCaptionScorer(config) if config.candidate_num > 1 else None
+  return loader, reference_captions(dataset), scorer
+
+def evaluate_checkpoint(config, checkpoint, valset=None, max_batches=None, seed=0):
+  '''
+  return result row of checkpoint: BLEU-4, ms per denoising step, generated tokens per second, parameter MB and peak memory MB
+  NOTE: peak memory is CUDA peak allocation during this checkpoint, or the peak RSS of the process so far on CPU
+  '''
+  loader, references, scorer = shared_data(config, valset)
+  model = load_checkpoint(config, checkpoint, ema=config.use_ema).eval()
+  run_config = checkpoint_config(config, model)
+  # candidate reranking decodes with the pretrained DistilBERT tokenizer
+  assert run_config.candidate_num == 1 or not run_config.train_embedding
+  tokenizer = data.load_tokenizer(run_config)
+  if device.type == "cuda":
+    torch.cuda.reset_peak_memory_stats()
+
+  step = make_denoise_step(model, run_config.inference_graph, run_config.batch_size, onnx_path=run_config.resolved_onnx_path())
+  step_time = benchmark_denoise_step(run_config, step)
+  rounding_index, clamp_index = nearest_embedding_indexes(run_config, model)
+  # every checkpoint samples from the same noise
+  torch.manual_seed(seed)
+  bleu, tokens_per_sec = evaluate_bleu(
+    run_config, step, model, tokenizer, loader, references, sys.stdout, max_batches=max_batches,
+    rounding_index=rounding_index, clamp_index=clamp_index, early_exit=run_config.early_exit,
+    candidate_num=run_config.candidate_num, scorer=scorer, corpus=run_config.evaluate_per_image)
+
+  if device.type == "cuda":
+    peak_memory = torch.cuda.max_memory_allocated() / 2 ** 20
+  else:
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10 # KB on linux
+  return {
+    "checkpoint": checkpoint,
+    "bleu": float(bleu),
+    "ms_per_step": step_time * 1000,
+    "tokens_per_sec": tokens_per_sec,
+    "param_mb": sum(p.numel() * p.element_size() for p in model.state_dict().values()) / 2 ** 20,
+    "peak_mb": peak_memory,
+  }
+
+def compare(config, checkpoints, valset=None, max_batches=None, workers=0):
+  '''
+  return result rows of checkpoints in order, evaluated in this process when workers is 0, else on a pool of workers processes
+  each worker loads the shared data once, latency of concurrent workers includes their contention
+  '''
+  if workers == 0:
+    return [evaluate_checkpoint(config, checkpoint, valset, max_batches) for checkpoint in checkpoints]
+  # spawn, as forked workers cannot reinitialize CUDA
+  with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+    futures = [pool.submit(evaluate_checkpoint, config, checkpoint, valset, max_batches) for checkpoint in checkpoints]
+    return [future.result() for future in futures]
+
+def format_table(rows):
+  '''
+  fixed width text table of result rows
+  '''
+  header = ["checkpoint", "BLEU-4", "ms/step", "tokens/sec", "params MB", "peak MB"]
+  lines = [[os.path.basename(row["checkpoint"]), f"{row['bleu']:.4f}", f"{row['ms_per_step']:.2f}", f"{row['tokens_per_sec']:.1f}", f"{row['param_mb']:.1f}", f"{row['peak_mb']:.1f}"] for row in rows]
+  widths = [max(len(line[i]) for line in [header] + lines) for i in range(len(header))]
+  return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip() for line in [header] + lines) + "\n"
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m clip_ddpm compare", description=__doc__.strip())
+  parser.add_argument("checkpoints", nargs="+", help="pickled models or glob patterns, quoted, e.g. 'trial_lr/*.pickle'. "
+                      "Checkpoints pickled without a run config are given the one of the command line")
+  parser.add_argument("--valset", default=None, help="split manifest directory (or legacy .valset file) all checkpoints are evaluated on, default {model_name}.split of the run config")
+  parser.add_argument("--max-batches", type=int, default=None, help="number of validation batches per checkpoint, default all")
+  parser.add_argument("--workers", type=int, default=0, help="worker processes, 0 evaluates sequentially in this process")
+  parser.add_argument("--out", default=None, help="comparison table file, default comparison.txt in output_dir")
+  add_config_arguments(parser)
+  args = parser.parse_args(argv)
+  config = config_from_args(args)
+
+  checkpoints = expand_checkpoints(args.checkpoints)
+  if len(checkpoints) == 0:
+    parser.error(f"no checkpoint matches {args.checkpoints}")
+  table = format_table(compare(config, checkpoints, args.valset, args.max_batches, args.workers))
+  print(table, end="")
+  out = args.out or os.path.join(config.output_dir, "comparison.txt")
+  with open(out, "w") as f:
+    f.write(table)
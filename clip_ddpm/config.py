@@ -0,0 +1,215 @@
+'''
+typed run configuration: every hyperparameter and path of training, sampling and evaluation in one frozen,
+json serializable object, passed explicitly to the data, model, diffusion and sampling functions
+so configurations with different settings can run in one process
+'''
+
+import argparse
+import dataclasses
+import json
+import os
+import typing
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+@dataclass(frozen=True)
+class DataSource():
+  '''
+  one caption dataset with CLIP features of each caption row
+  '''
+  name: str
+  captions: str # flickr8k style captions.txt (comma separated, image column), flickr30k style captions.csv ("|" separated, image_name column) or COCO style captions json
+  image_features: str # pickled CLIP image features, one row per caption row
+  text_features: str # pickled CLIP text features, one row per caption row
+
+DEFAULT_SOURCES = (
+  DataSource("flickr8k", "./flickr8k/captions.txt", "./flickr8k/image_all_final.pickle", "./flickr8k/text_all_final.pickle"),
+  DataSource("flickr30k", "./flickr30k/captions.csv", "./flickr30k/flickr30k_clip_image.pickle", "./flickr30k/flickr30k_clip_text.pickle"),
+)
+
+@dataclass(frozen=True)
+class RunConfig():
+  # hyperparameters
+  debug: bool = False
+  continue_train: bool = False
+  batch_size: int = 8
+  max_length: int = 16 # max text length
+  bucket_by_length: bool = False # if batches group captions of similar length and are cut to the longest caption in the batch instead of max_length
+  learning_rate: float = 1e-4
+  end_learning_rate: float = 5e-5 # learning rate is reduced to end_learning_rate, equal to learning_rate for no changing learning rate
+  scheduler: str = "linspace" # scheduler of learning rate, "linspace", "logspace" or "cosine_annealing"
+  scheduler_per_step: bool = False # if scheduler is evaluated at every optimizer step instead of held constant through each epoch
+  warmup_steps: int = 0 # optimizer steps over which learning rate ramps linearly from 0 up to its scheduled value
+  accumulation_steps: int = 1 # batches whose gradients are accumulated into one optimizer step, effective batch size is batch_size * accumulation_steps
+  optimizer: str = "adamw" # AdamW implementation, "adamw": torch default, "foreach": multi-tensor, "fused": fused CUDA kernel, "flat": over parameters flattened into one contiguous buffer per param group
+  weight_decay: float = 0.01
+  weight_decay_skip_norm_bias: bool = False # if LayerNorm weights and biases are not weight decayed
+  benchmark_optimizer: bool = False # if optimizer step time of every AdamW implementation is written to summary
+  ema_decay: float = 0 # decay of exponential moving average of trainable parameters saved with the model, <= 0 means not using
+  ema_on_host: bool = False # if EMA weights are kept in CPU memory instead of on the accelerator
+  ema_update_interval: int = 1 # optimizer steps between EMA updates, each update decays by ema_decay ** ema_update_interval
+  use_ema: bool = True # if evaluation and sampling use the EMA weights of checkpoints that carry them
+  train_set_ratio: float = 0.8
+  split_dir: str = "./splits" # train / validation split manifests, computed once and shared by every trial on the same caption rows, train_set_ratio, split_by_image and split_seed
+  split_by_image: bool = False # if the split is of images instead of caption rows, so no validation image has captions in the training split
+  split_seed: int = 0
+  early_stop_ratio: float = 1.05
+  val_sample_size: Optional[int] = None # number of sample steps in each diffuse sequence in validation, default sample_size
+  async_validation: Optional[str] = None # None: validation blocks training at each epoch end, "thread" / "process": a weight snapshot is validated in a background thread or worker process while the next epoch trains, results are logged and checked for early stop one epoch later
+  deterministic_validation: bool = False # if validation uses a fixed stratified grid of val_sample_size timesteps and seeded noise from a bank generated once, so losses of different epochs are comparable
+  val_noise_bank_size: int = 256 # noise samples in the bank, validation captions cycle through it
+  val_noise_seed: int = 0
+  epoch_num: int = 5
+  dynamic_rounding_weight: float = -1 # weight of rounding term with respect to x_t loss, <0 means not using
+  rounding_weight: float = 0.5 # weight of rounding term, the probability of regenerated sequence, not used if using dynamic rounding
+  loss_func: str = "series_sum_sample_mean" # loss function used between embedding, "series_sum_sample_mean", "series_sum", "mse_series_mean" or "mse_series_sum"
+  clip_adding_method: str = "concat" # "concat": CLIP feature are appended to sequence of word embedding, "add": added as position embedding
+  classifier_free_weight: float = 0 # classifier guidance, <= 0 means no guidance
+  classifier_free_prob: float = 0.2
+  train_embedding: bool = False # if model use pretrained distilbert embedding, or learn a 16 embedding for each word and project to 768 before pass to bert
+  restrict_vocab: bool = False # if lm_head only projects onto word-pieces occurring in training captions, only used when train_embedding is False
+  cache_x_0: bool = False # if frozen x_0 embedding is precomputed once into a memory-mapped fp16 store, only used when train_embedding is False
+  x_0_cache_path: Optional[str] = None # default ./x_0_cache_maxlen{max_length}.npy, metadata with embedding and caption rows fingerprints is stored next to it as .json
+  gradient_checkpointing: bool = False # if activations of the DistilBERT transformer layers are recomputed in backward instead of stored, trading step time for memory of a larger batch_size
+  benchmark_gradient_checkpointing: bool = False # if training step time, samples/sec, peak activation memory and largest fitting batch size with and without gradient checkpointing are written to summary
+
+  # diffusion hyperparameter
+  beta_min: float = 0.0001
+  beta_max: float = 0.02
+  step_tot: int = 1000 # total noise adding steps
+  cosin_schedule: bool = True # if alpha sequence is scheduled in cosin instead of linear patten
+  sample_size: int = 100 # number of sample steps in each diffuse sequence
+  x_0_prediction: bool = True # if model predicts x_0 or x_{t-1}
+  x_t_step_interval: int = 100
+  use_x_t_loss: bool = True
+  use_x_1_loss: bool = True # if using x_1 loss
+  use_prob_loss: bool = True # if using prob loss
+
+  # data and paths
+  sources: Tuple[DataSource, ...] = DEFAULT_SOURCES # caption datasets, rows are stacked in this order
+  vocab_captions: str = "./flickr8k/captions.txt" # captions the word vocabulary is built from when train_embedding
+  vocab_min_count: int = 10 # words occurring more often are in the word vocabulary
+  deduplicate_image_features: bool = True # if dataset keeps one CLIP image feature per image and a caption to image index, instead of one per caption
+  feature_store: Optional[str] = None # directory written by clip_ddpm/feature_store.py, memory-mapped instead of loading the CLIP feature pickles
+  shard_dir: Optional[str] = None # sharded dataset directory (see clip_ddpm/shards.py), training streams its shards from disk instead of loading sources, the first train_set_ratio of shards are trained on
+  shuffle_buffer_size: int = 4096 # streamed rows drawn at random from a buffer of this many rows
+  loader_workers: int = 0 # DataLoader worker processes reading shards, each worker reads its own shards
+  prefetch_factor: int = 2 # batches prepared ahead by each loader worker
+  tokenizer_path: str = "./tokenizers/distilbert-base-uncased-local/"
+  distilbert_path: str = "./models/distilbert-base-uncased-local"
+  clip_processor_path: str = "./tokenizers/openai/clip-vit-base-patch32-local"
+  clip_path: str = "./models/openai/clip-vit-base-patch32-local"
+  output_dir: str = "." # checkpoint, validation split, summary and run config are written here
+
+  # sampling and evaluation
+  sample_steps: int = 5 # denoising passes per caption in BLEU evaluation
+  early_exit: bool = False # if a caption stops being denoised once its decoded tokens stop changing, sample_steps is then the maximum
+  early_exit_patience: int = 1 # number of consecutive unchanged passes before a caption is retired
+  early_exit_tolerance: float = 0.01 # maximum relative change of denoised feature between passes for a caption to count as unchanged
+  evaluate_per_image: bool = False # if BLEU is corpus BLEU over distinct validation images, each captioned once against all references, instead of once per caption row
+  candidate_num: int = 1 # noise seeds drawn per image, >1 keeps the candidate caption with highest CLIP image-text similarity
+  clamp_method: Optional[str] = None # None: intermediate x_0 prediction is fed back as is, "exact" / "ivfpq": snapped to nearest token embedding between passes
+  rounding_method: str = "lm_head" # decoding of final denoised output, "lm_head": argmax of lm_head projection, "exact": nearest token embedding, "ivfpq": approximate nearest token embedding with faiss
+  ivfpq_nprobe: int = 8 # inverted lists searched per query by "ivfpq" rounding and clamping, higher is closer to exact and slower
+  benchmark_rounding: bool = False # if lm_head and nearest embedding decoding latency and agreement are written to summary
+
+  # inference graph
+  inference_graph: Optional[str] = None # None: DistilBertModel.forward, "static": StaticInferenceModel, "torchscript": traced StaticInferenceModel, "compile": torch.compile StaticInferenceModel, "onnxruntime": exported StaticInferenceModel on onnxruntime CPU, "cpu": StaticInferenceModel copy on CPU, "int8_cpu": int8 dynamic quantized copy on CPU
+  onnx_path: Optional[str] = None # default {model_name}.onnx in output_dir, exports are saved with a fingerprint of the exported weights inserted before the extension
+  benchmark_inference: bool = False # if per-step latency of every inference graph is written to summary
+
+  # int8 quantization
+  quantization_report: bool = False # if fp32 and int8 dynamic quantized CPU inference are compared on BLEU and tokens/sec
+  quantization_calibration_size: int = 64 # number of cached validation CLIP features used to choose modules kept in fp32
+  quantization_tolerance: float = 0.98 # minimum argmax token agreement with fp32 for a module group to be quantized
+  quantization_report_batches: int = 100 # number of validation batches used in report BLEU
+
+  def __setstate__(self, state):
+    # configs pickled into checkpoints before a field existed get its default
+    self.__dict__.update({f.name: f.default for f in dataclasses.fields(self)})
+    self.__dict__.update(state)
+
+  @property
+  def in_channel(self):
+    return 16 if self.train_embedding else 768
+
+  @property
+  def model_name(self):
+    return f"epoch{self.epoch_num}_loss{self.loss_func}_lr{'%.0E' % self.learning_rate}-{'%.0E' % self.end_learning_rate}_scheduler{self.scheduler}_round{'%.0E' % self.rounding_weight}_dynamic{self.dynamic_rounding_weight}\
+_clip{self.clip_adding_method}_class_weight{'%.0E' % self.classifier_free_weight}_class_prob{'%.0E' % self.classifier_free_prob}_train-embed{self.train_embedding}\
+_samplesize{self.sample_size}_x_0_predict{self.x_0_prediction}_X_INTERVAL{self.x_t_step_interval}_use_x_t{self.use_x_t_loss}_use_x_1{self.use_x_1_loss}_use_prob{self.use_prob_loss}"
+
+  def path(self, suffix):
+    '''
+    {output_dir}/{model_name}{suffix}, e.g. suffix ".pickle" for the checkpoint
+    '''
+    return os.path.join(self.output_dir, f"{self.model_name}{suffix}")
+
+  def resolved_x_0_cache_path(self):
+    return self.x_0_cache_path or f"./x_0_cache_maxlen{self.max_length}.npy"
+
+  def resolved_onnx_path(self):
+    return self.onnx_path or self.path(".onnx")
+
+  def replace(self, **changes):
+    return dataclasses.replace(self, **changes)
+
+  def to_dict(self):
+    return dataclasses.asdict(self)
+
+  @classmethod
+  def from_dict(cls, d):
+    d = dict(d)
+    unknown = set(d) - {f.name for f in dataclasses.fields(cls)}
+    if unknown:
+      raise ValueError(f"unknown run config fields: {sorted(unknown)}")
+    if "sources" in d:
+      d["sources"] = tuple(DataSource(**source) for source in d["sources"])
+    return cls(**d)
+
+  def save(self, path=None):
+    '''
+    write config as json, default {model_name}.json in output_dir
+    '''
+    path = path or self.path(".json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+      json.dump(self.to_dict(), f, indent=2)
+    return path
+
+  @classmethod
+  def load(cls, path):
+    with open(path) as f:
+      return cls.from_dict(json.load(f))
+
+def parse_bool(value):
+  if value.lower() in ["true", "1", "yes"]:
+    return True
+  if value.lower() in ["false", "0", "no"]:
+    return False
+  raise argparse.ArgumentTypeError(f"expected true or false, got {value}")
+
+def add_config_arguments(parser):
+  '''
+  add --config FILE and one --field-name option per scalar RunConfig field, sources are only set from a config file
+  '''
+  parser.add_argument("--config", default=None, help="run config json, fields not given on the command line are taken from it")
+  hints = typing.get_type_hints(RunConfig)
+  group = parser.add_argument_group("run config")
+  for f in dataclasses.fields(RunConfig):
+    field_type = hints[f.name]
+    if typing.get_origin(field_type) is typing.Union:
+      # Optional[X]
+      field_type = typing.get_args(field_type)[0]
+    if field_type not in [bool, int, float, str]:
+      continue
+    group.add_argument(f"--{f.name.replace('_', '-')}", dest=f.name, default=None, metavar=field_type.__name__.upper(),
+                       type=parse_bool if field_type == bool else field_type, help=f"default {f.default}")
+
+def config_from_args(args):
+  '''
+  RunConfig of the --config file (or defaults), with options given on the command line replacing its fields
+  '''
+  config = RunConfig.load(args.config) if args.config is not None else RunConfig()
+  overrides = {f.name: getattr(args, f.name) for f in dataclasses.fields(RunConfig) if getattr(args, f.name, None) is not None}
+  return config.replace(**overrides)
@@ -0,0 +1,416 @@
+'''
+Flickr8k + Flickr30k CLIP feature caption dataset, tokenizers, batching, the x_0 embedding cache and loaders streaming sharded datasets
+loaders are cached on the data fields of RunConfig, so configurations run in one process share features, tokenizer and dataset
+'''
+
+import copy
+import functools
+import itertools
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+
+from . import splits
+from .utils import get_device, load, state_dict_fingerprint
+
+device = get_device()
+
+def load_clip_features(sources, feature_store_path=None):
+  '''
+  return (image_set, text_set) CLIP features of the caption rows of sources, stacked in order, shape [caption_num, clip_dim]
+  '''
+  if feature_store_path is None:
+    image_set = [torch.load(source.image_features).to(device).detach() for source in sources]
+    text_set = [torch.load(source.text_features).to(device).detach() for source in sources]
+    return torch.vstack(image_set), torch.vstack(text_set)
+
+  from . import feature_store
+  # zero-copy on CPU, stored dtype is kept and cast to float32 per sample
+  return feature_store.open_store(feature_store_path).tensors([source.name for source in sources])
+
+def read_captions(path):
+  '''
+  caption rows of flickr8k style captions.txt (comma separated), flickr30k style captions.csv ("|" separated)
+  or COCO style captions_*.json (one row per annotation in file order), columns image, caption
+  '''
+  if path.endswith(".json"):
+    with open(path) as f:
+      coco = json.load(f)
+    file_names = {image["id"]: image["file_name"] for image in coco["images"]}
+    return pd.DataFrame({
+      "image": [file_names[annotation["image_id"]] for annotation in coco["annotations"]],
+      "caption": [annotation["caption"] for annotation in coco["annotations"]],
+    })
+  if path.endswith(".csv"):
+    return pd.read_csv(path, sep='|').rename(columns={"image_name": "image"})[["image", "caption"]]
+  return pd.read_csv(path)[["image", "caption"]]
+
+def load_captions(sources):
+  '''
+  return (captions, image names) of the caption rows of sources, stacked in order
+  '''
+  data = pd.concat([read_captions(source.captions) for source in sources], ignore_index=True)
+  return data["caption"], data["image"]
+
+@functools.lru_cache(maxsize=None)
+def build_vocab_dict(vocab_captions, min_count=10):
+  '''
+  word vocabulary of the captions file, words occurring more than min_count times, used when train_embedding
+  '''
+  from spacy.lang.en import English
+  from collections import Counter
+
+  captions = read_captions(vocab_captions)["caption"]
+  nlp = English()
+
+  sentence_lst = []
+
+  for sentences in captions:
+    word_lst = [x.text.lower() for x in nlp.tokenizer(sentences)]
+    spl = [[]]
+    for x, y in itertools.groupby(word_lst, lambda z: z == '.'):
+        spl[-1].extend(y)
+        if x: spl.append([])
+    sentence_lst.extend(spl[:-1])
+
+  counter = Counter()
+  for input_ids in sentence_lst:
+      counter.update(input_ids)
+  vocab_dict = {'START': 0, 'END': 1, 'UNK':2, 'PAD':3}
+  for k, v in counter.items():
+      if v > min_count:
+        vocab_dict[k] = len(vocab_dict)
+  return vocab_dict
+
+class DictTokenizer():
+  def __init__(self, dictionary) -> None:
+    self.dictionary = dictionary
+
+  def __getitem__(self, i):
+    return self.dictionary[i]
+
+  def __len__(self):
+    return len(self.dictionary)
+
+  def decode(self, index):
+    return " ".join([list(self.dictionary.keys())[list(self.dictionary.values()).index(i.item())] for i in index])
+
+def load_tokenizer(config):
+  if config.train_embedding:
+    return cached_dict_tokenizer(config.vocab_captions, config.vocab_min_count)
+  return cached_distilbert_tokenizer(config.tokenizer_path)
+
+@functools.lru_cache(maxsize=None)
+def cached_dict_tokenizer(vocab_captions, min_count):
+  return DictTokenizer(build_vocab_dict(vocab_captions, min_count))
+
+@functools.lru_cache(maxsize=None)
+def cached_distilbert_tokenizer(path):
+  from transformers import DistilBertTokenizer
+  return DistilBertTokenizer.from_pretrained(path, local_files_only=True)
+
+def vocab_size(tokenizer):
+  if isinstance(tokenizer, DictTokenizer):
+    return len(tokenizer)
+  return tokenizer.vocab_size
+
+def tokenize_captions(tokenizer, captions, max_length):
+  '''
+  return (input_ids, lengths) numpy arrays of captions tokenized and padded as in FlickrCLIPDataset items
+    input_ids: shape [caption_num, max_length] int32
+    lengths: non-padding tokens of each caption, shape [caption_num] int16
+  '''
+  if not isinstance(tokenizer, DictTokenizer):
+    tokens = tokenizer(text=list(captions), return_tensors="np", padding='max_length', truncation=True, max_length=max_length)
+    return tokens["input_ids"].astype(np.int32), tokens["attention_mask"].sum(axis=-1).astype(np.int16)
+  vocab_dict = tokenizer.dictionary
+  input_ids = np.full((len(captions), max_length), vocab_dict['UNK'], dtype=np.int32)
+  lengths = np.zeros(len(captions), dtype=np.int16)
+  for row, caption in enumerate(captions):
+    ids = [0] + [vocab_dict.get(x, vocab_dict['UNK']) for x in caption[:max_length-2]] + [1]
+    input_ids[row, :len(ids)] = ids
+    lengths[row] = len(ids)
+  return input_ids, lengths
+
+class FlickrCLIPDataset(torch.utils.data.Dataset):
+  def __init__(self, captions, images, tokenizer, image_set, text_set, max_length=16, deduplicate_image_features=True) -> None:
+    images.name = "image"
+    captions.name = "caption"
+    self.data = pd.concat([images, captions], axis=1)
+    self.tokenizer = tokenizer
+    self.max_length = max_length
+    self.x_0_cache = None # memory-mapped [len, max_length, in_channel] fp16 array, set by load_x_0_cache
+
+    self.image_index = None # caption row to image_features row, set when image features are deduplicated
+    if deduplicate_image_features:
+      self.deduplicate_image_features(image_set)
+    if self.image_index is None:
+      self.train_dataset = torch.utils.data.TensorDataset(image_set.to(device), text_set.to(device))
+    else:
+      self.text_features = text_set.to(device)
+
+  def deduplicate_image_features(self, image_set, check_chunk=65536, tolerance=1e-3):
+    '''
+    keep the CLIP image feature of the first caption of each image,
+    rows of the same image are checked to agree, otherwise per caption features are kept
+    '''
+    image_codes, _ = pd.factorize(self.data["image"])
+    image_index = torch.from_numpy(image_codes)
+    first_rows = torch.from_numpy(np.unique(image_codes, return_index=True)[1])
+    image_features = image_set[first_rows.to(image_set.device)]
+
+    for start in range(0, len(image_set), check_chunk):
+      rows = slice(start, start + check_chunk)
+      difference = (image_set[rows].float() - image_features[image_index[rows].to(image_set.device)].float()).abs().max()
+      if difference > tolerance:
+        print(f"captions of the same image have different CLIP image features (max difference {difference}), not deduplicating")
+        return
+    self.image_index = image_index.to(device)
+    self.image_features = image_features.to(device)
+    print(f"deduplicated CLIP image features: {len(image_set)} caption rows to {len(image_features)} images")
+
+  def view(self, max_length):
+    '''
+    shallow copy sharing features and captions, tokenizing to max_length, without x_0 cache
+    '''
+    dataset = copy.copy(self)
+    dataset.max_length = max_length
+    dataset.x_0_cache = None
+    return dataset
+
+  def __len__(self):
+    return len(self.data)
+
+  def caption_lengths(self):
+    '''
+    number of non-padding tokens of each caption, used by LengthBucketSampler
+    '''
+    if not isinstance(self.tokenizer, DictTokenizer):
+      ids = self.tokenizer(text=list(self.data["caption"]), truncation=True, max_length=self.max_length)["input_ids"]
+      return torch.tensor([len(i) for i in ids])
+    return torch.tensor((self.data["caption"].str.len().clip(upper=self.max_length - 2) + 2).tolist())
+
+  def __getitem__(self, idx):
+    if self.image_index is None:
+      image_clip, text_clip = self.train_dataset[idx]
+    else:
+      image_clip, text_clip = self.image_features[self.image_index[idx]], self.text_features[idx]
+    image_clip, text_clip = image_clip.to(device, torch.float32), text_clip.to(device, torch.float32)
+    if not isinstance(self.tokenizer, DictTokenizer):
+      tokens = self.tokenizer(text=self.data.loc[idx]["caption"], return_tensors="pt", padding='max_length', truncation=True, max_length=self.max_length)
+    else:
+      vocab_dict = self.tokenizer.dictionary
+      ids = [0] + [vocab_dict.get(x, vocab_dict['UNK']) for x in self.data.loc[idx]["caption"][:self.max_length-2]] + [1]
+      pad_length = max(0, self.max_length - len(ids))
+      tokens = dict()
+      tokens["input_ids"] = torch.tensor(ids + [vocab_dict['UNK']] * pad_length)
+      tokens["attention_mask"] = torch.tensor([1] * len(ids) + [0] * pad_length)
+
+    item = {
+      "image_clip": image_clip,
+      "text_clip": text_clip,
+      "input_ids": tokens["input_ids"].squeeze().to(device),
+      "attention_mask": tokens["attention_mask"].squeeze().to(device),
+      "text": self.data.loc[idx]["caption"],
+      "image": self.data.loc[idx]["image"]
+    }
+    if self.x_0_cache is not None:
+      item["x_0"] = torch.from_numpy(np.array(self.x_0_cache[idx])).to(device, torch.float32)
+    return item
+
+def load_dataset(config):
+  '''
+  FlickrCLIPDataset over config.sources tokenized to config.max_length,
+  features are loaded once per distinct data configuration and shared by the returned views
+  '''
+  return cached_dataset(config.sources, config.feature_store, config.deduplicate_image_features, load_tokenizer(config)).view(config.max_length)
+
+@functools.lru_cache(maxsize=None)
+def cached_dataset(sources, feature_store_path, deduplicate_image_features, tokenizer):
+  # the loaded per caption features are dropped once deduplicated
+  captions, images = load_captions(sources)
+  image_set, text_set = load_clip_features(sources, feature_store_path)
+  return FlickrCLIPDataset(captions, images, tokenizer, image_set, text_set, deduplicate_image_features=deduplicate_image_features)
+
+def split_dataset(config, dataset):
+  '''
+  return (train_set, val_set) subsets of dataset, of the split manifest shared by trials configured alike (see splits.py),
+  or of the split the checkpoint was trained on when continue_train
+  '''
+  if config.continue_train:
+    train, val = load_run_split(config, dataset)
+  else:
+    train, val = splits.shared_split(config, dataset)
+  return torch.utils.data.Subset(dataset, train), torch.utils.data.Subset(dataset, val)
+
+def load_run_split(config, dataset, path=None):
+  '''
+  return (train, val) row indices of the split a run trained on, path is its split manifest directory (default {model_name}.split)
+  or a .valset Subset pickled by runs before split manifests (default {model_name}.valset when there is no .split)
+  '''
+  if path is None:
+    path = config.path(".split") if os.path.exists(config.path(".split")) else config.path(".valset")
+  if os.path.isdir(path):
+    return splits.load_split(path, splits.dataset_fingerprint(dataset))
+  val = np.asarray(load(path).indices, dtype=np.int32)
+  return np.setdiff1d(np.arange(len(dataset), dtype=np.int32), val), val
+
+def load_val_set(config, dataset, path=None):
+  '''
+  validation subset of the split a run trained on (see load_run_split), rebound to dataset
+  '''
+  return torch.utils.data.Subset(dataset, load_run_split(config, dataset, path)[1])
+
+def save_run_split(config, dataset, train_set, val_set):
+  '''
+  record the split of a run as {model_name}.split in output_dir, read by evaluation and continue_train
+  '''
+  splits.save_split(config.path(".split"), train_set.indices, val_set.indices, splits.dataset_fingerprint(dataset), len(dataset),
+                    config.train_set_ratio, config.split_by_image, config.split_seed)
+
+def split_shards(config):
+  '''
+  return (train_shards, val_shards) file names of config.shard_dir, the first train_set_ratio of shards are trained on
+  '''
+  from .shards import read_index
+  files = [shard["file"] for shard in read_index(config.shard_dir)["shards"]]
+  train_len = int(len(files) * config.train_set_ratio)
+  assert 0 < train_len < len(files), f"{len(files)} shards in {config.shard_dir} cannot be split with train_set_ratio {config.train_set_ratio}"
+  return files[:train_len], files[train_len:]
+
+def make_stream_loader(config, shards, shuffle):
+  '''
+  DataLoader streaming shards of config.shard_dir, batches are on CPU and moved to device by train_func
+  '''
+  from .shards import ShardedCLIPDataset, tokenizer_name
+  assert not config.bucket_by_length, "length bucketing needs random access, not supported when streaming shards"
+  dataset = ShardedCLIPDataset(config.shard_dir, shards, shuffle, config.shuffle_buffer_size, seed=int(torch.randint(2 ** 31, ())),
+                               batch_size=config.batch_size, num_workers=config.loader_workers)
+  if not (dataset.index["tokenizer"], dataset.index["max_length"]) == (tokenizer_name(config), config.max_length):
+    raise ValueError(f"{config.shard_dir} is tokenized by {dataset.index['tokenizer']} to max_length {dataset.index['max_length']}, "
+                     f"run config by {tokenizer_name(config)} to {config.max_length}")
+  workers = {"num_workers": config.loader_workers, "prefetch_factor": config.prefetch_factor} if config.loader_workers > 0 else {}
+  return DataLoader(dataset, batch_size=config.batch_size, drop_last=True, pin_memory=device.type == "cuda", **workers)
+
+def make_loader(config, dataset, subset, shuffle):
+  '''
+  DataLoader over subset of dataset, batches are length bucketed and trimmed when bucket_by_length,
+  when config.shard_dir is set dataset is None and subset is a list of shard files, streamed by make_stream_loader
+  '''
+  if config.shard_dir is not None:
+    return make_stream_loader(config, subset, shuffle)
+  if config.bucket_by_length:
+    caption_lengths = dataset.caption_lengths()
+    return DataLoader(subset, batch_sampler=LengthBucketSampler(caption_lengths[np.asarray(subset.indices, dtype=np.int64)], config.batch_size, shuffle=shuffle), collate_fn=trim_padding_collate)
+  return DataLoader(subset, shuffle=shuffle, batch_size=config.batch_size, drop_last=True)
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+  '''
+  batch sampler grouping captions of similar length,
+  indices are shuffled, sorted by length within pools of pool_batches batches, then batch order is shuffled
+  '''
+  def __init__(self, lengths, batch_size, shuffle=True, drop_last=True, pool_batches=50) -> None:
+    '''
+    inputs:
+      lengths: caption length of each sample in the (sub)dataset, shape [dataset_len]
+    '''
+    self.lengths = lengths
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.drop_last = drop_last
+    self.pool_size = batch_size * pool_batches
+
+  def __iter__(self):
+    order = torch.randperm(len(self.lengths)) if self.shuffle else torch.arange(len(self.lengths))
+    batches = []
+    for pool in order.split(self.pool_size):
+      pool = pool[self.lengths[pool].argsort(stable=True)]
+      batches.extend(pool.split(self.batch_size))
+    if self.drop_last and len(batches[-1]) < self.batch_size:
+      # pools are whole multiples of batch_size, only the very last batch can be incomplete
+      batches = batches[:-1]
+    if self.shuffle:
+      batches = [batches[i] for i in torch.randperm(len(batches))]
+    return iter([batch.tolist() for batch in batches])
+
+  def __len__(self):
+    if self.drop_last:
+      return len(self.lengths) // self.batch_size
+    return math.ceil(len(self.lengths) / self.batch_size)
+
+def trim_padding_collate(samples):
+  '''
+  default collate, then cut sequence tensors to the longest caption in the batch
+  '''
+  batch = torch.utils.data.dataloader.default_collate(samples)
+  seq_len = int(batch["attention_mask"].sum(dim=-1).max())
+  for key in ("input_ids", "attention_mask", "x_0"):
+    if key in batch:
+      batch[key] = batch[key][:, :seq_len]
+  return batch
+
+def build_sub_vocab(dataset, indices):
+  '''
+  return sorted tokenizer ids occurring in captions at indices of dataset, plus tokenizer special tokens
+  '''
+  ids = dataset.tokenizer(text=list(dataset.data["caption"].iloc[list(indices)]), truncation=True, max_length=dataset.max_length)["input_ids"]
+  return torch.tensor(sorted(set(itertools.chain.from_iterable(ids)) | set(dataset.tokenizer.all_special_ids)))
+
+def build_shard_sub_vocab(config, shards, tokenizer):
+  '''
+  build_sub_vocab of the pre-tokenized captions in shards of config.shard_dir
+  '''
+  from .shards import ShardedCLIPDataset
+  ids = ShardedCLIPDataset(config.shard_dir, shards, shuffle=False).token_ids()
+  return torch.tensor(sorted(set(ids) | set(tokenizer.all_special_ids)))
+
+def embedding_fingerprint(embedding):
+  '''
+  sha1 over the embedding module weights (word, position embedding and LayerNorm),
+  ties a x_0 cache to the checkpoint it was computed from
+  '''
+  return state_dict_fingerprint(embedding)
+
+def x_0_cache_meta(embedding, dataset):
+  '''
+  metadata stored next to a x_0 cache, the cache is stale unless embedding weights, caption rows and max_length all match
+  '''
+  return {"fingerprint": embedding_fingerprint(embedding), "dataset": splits.dataset_fingerprint(dataset), "length": len(dataset), "max_length": dataset.max_length}
+
+def build_x_0_cache(dataset, embedding, path, batch_size=256):
+  '''
+  compute embedding(input_ids) of every caption in dataset and store in a fp16 memmap at path
+  NOTE: stored value is embedding output in eval mode, dropout is re-applied in train_func
+  '''
+  cache = np.lib.format.open_memmap(path, mode="w+", dtype=np.float16, shape=(len(dataset), dataset.max_length, embedding.word_embeddings.embedding_dim))
+  was_training = embedding.training
+  embedding.eval()
+  with torch.no_grad():
+    for start in range(0, len(dataset), batch_size):
+      input_ids = torch.stack([dataset[i]["input_ids"] for i in range(start, min(start + batch_size, len(dataset)))])
+      cache[start:start + input_ids.shape[0]] = embedding(input_ids).half().cpu().numpy()
+  embedding.train(was_training)
+  cache.flush()
+  del cache
+
+  with open(f"{path}.json", "w") as f:
+    json.dump(x_0_cache_meta(embedding, dataset), f)
+
+def load_x_0_cache(path, embedding, dataset):
+  '''
+  return read-only memmap of x_0 cache, (re)build the cache if missing or computed from different embedding weights
+  '''
+  expected = x_0_cache_meta(embedding, dataset)
+  meta = None
+  if os.path.exists(path) and os.path.exists(f"{path}.json"):
+    with open(f"{path}.json") as f:
+      meta = json.load(f)
+  if not meta == expected:
+    print(f"x_0 cache {path} missing or stale, rebuilding")
+    build_x_0_cache(dataset, embedding, path)
+  return np.load(path, mmap_mode="r")
@@ -0,0 +1,191 @@
+'''
+forward diffusion of caption embeddings and the training loss
+'''
+
+import functools
+import math
+
+import torch
+from torch import nn
+
+from .utils import get_device
+
+device = get_device()
+
+def series_sum_sample_mean(x_hat, x, batch_size):
+  return (x_hat - x).abs().sum(dim=1).mean()
+
+def series_sum(x_hat, x, batch_size):
+  return (x_hat - x).abs().sum() / batch_size / 768 / 100
+
+def mse_series_mean(x_hat, x, batch_size):
+  return ((x_hat - x) ** 2).sum(dim=[-2, -1]).sqrt().mean()
+
+def mse_series_sum(x_hat, x, batch_size):
+  return ((x_hat - x) ** 2).sum(dim=[-2, -1]).sqrt().sum() / batch_size
+
+# RunConfig.loss_func names
+LOSS_FUNCS = {f.__name__: f for f in [series_sum_sample_mean, series_sum, mse_series_mean, mse_series_sum]}
+
+@functools.lru_cache(maxsize=None)
+def get_alpha_cumprod(cosin_schedule, step_tot, beta_min, beta_max):
+  '''
+  cumulative product of alpha over step_tot noise adding steps, shape [step_tot], built once per schedule
+  '''
+  if cosin_schedule:
+    def scheduler(t):
+      s = 0.008 # smalle value prevent beta_t too small, from Improved DDPM paper
+      return torch.cos(math.pi / 2 * (t/step_tot + s) / (1 + s)) ** 2
+    ts = torch.arange(step_tot).to(device)
+    return scheduler(ts) / scheduler(torch.zeros(1, device=device))
+  betas = torch.hstack([torch.zeros(1), torch.linspace(beta_min, beta_max, step_tot)]).to(device)
+  alphas = 1 - betas
+  return torch.cumprod(alphas[:-1], 0)
+
+@functools.lru_cache(maxsize=None)
+def stratified_timesteps(sample_num, step_tot):
+  '''
+  fixed timestep grid, the midpoint of each of sample_num equal strata of [0, step_tot), shape [sample_num]
+  '''
+  return ((torch.arange(sample_num, device=device) + 0.5) * step_tot / sample_num).long()
+
+@functools.lru_cache(maxsize=None)
+def noise_bank(bank_size, seq_len, in_channel, seed):
+  '''
+  seeded gaussian noise generated once per process, shape [bank_size, 3, seq_len, in_channel], 
+  the 3 slots are noise of x_t, x_1 and x_tgt of a caption
+  '''
+  generator = torch.Generator().manual_seed(seed)
+  return torch.randn((bank_size, 3, seq_len, in_channel), generator=generator).to(device)
+
+def diffuse_t(config, x, t, noise=None):
+  '''
+  input:
+    x_shape: [batch_size, seq_len, in_channel]
+    t shape: [sample num] 
+      NOTE: not necessary have hyperparameter sample_size number of element, to allow single diffuse generation
+    noise: shape same as x, shared by all t, default freshly drawn
+
+  return shape [sample_num * batch_size, seq_len, in_channel]
+  '''
+  batch_size, seq_len, _ = x.shape
+  alpha_cumprod = get_alpha_cumprod(config.cosin_schedule, config.step_tot, config.beta_min, config.beta_max)
+  sample_shape = (t.numel(), *(1, ) * len(x.shape))
+
+  if noise is None:
+    noise = torch.normal(0, 1, x.shape).to(device)
+  mean = torch.sqrt(alpha_cumprod[t].reshape(sample_shape)) * x 
+  epsilon = noise * torch.sqrt(1 - alpha_cumprod[t]).reshape(sample_shape)
+  return (mean + epsilon).reshape((t.numel() * batch_size, seq_len, config.in_channel))
+
+def generate_diffuse_pair(config, x_0, t, t_next=None, noise=None, noise_next=None):
+  '''
+  input:
+    x_0 shape: [batch_size, seq_len, in_channel],
+    t shape: [sample_num] 
+      NOTE: not necessary have hyperparameter sample_size number of element, to allow single diffuse generation
+    noise, noise_next: noise of net input and of net target at t_next, as in diffuse_t
+  
+  return (net input, net target)
+    net input shape: [sample_num * batch_size, seq_len, in_channel]
+    net target shape: if t_next is None then [batch_size, seq_len, in_channel] else [sample_num * batch_size, seq_len, in_channel]
+  '''
+  if config.x_0_prediction:
+    # predict x_0
+    return (diffuse_t(config, x_0, t, noise), x_0)
+
+  # predict x_{t_next}
+  return (diffuse_t(config, x_0, t, noise), diffuse_t(config, x_0, t_next, noise_next))
+
+def token_log_prob(logits, idx, mask):
+  '''
+  log probability of target tokens under logits, log_softmax then gather
+  input:
+    logits: shape [N, seq_len, vocab_size], or [non-padding position num, vocab_size] packed by DistilBertModel.forward
+    idx, mask shape: [N, seq_len]
+  return shape [N, seq_len], 0 at padding positions of packed logits
+  '''
+  if logits.dim() == 2:
+    valid = mask.bool()
+    log_prob = logits.new_zeros(mask.shape)
+    log_prob[valid] = nn.functional.log_softmax(logits, dim=-1).gather(-1, idx[valid].unsqueeze(-1)).squeeze(-1)
+    return log_prob
+  return nn.functional.log_softmax(logits, dim=-1).gather(-1, idx.unsqueeze(-1)).squeeze(-1)
+
+def loss(config, model, x_t, x_1, x_tgt, x_0, image_clip, text_clip, mask, idx, rounding_weight=None, generator=None):
+  ''' 
+  input: 
+    model, 
+    x_t, x_tgt shape: [sample_num * batch_size, seq_len, in_channel]
+      NOTE: x_tgt only used when x_0_prediction is False
+    x_1, x_0 shape: [batch_size, seq_len, in_channel]
+    image_clip, text_clip shape: [batch_size, clip_dim]
+    mask shape: [batch_size, seq_len]
+    idx shape: [batch_size, seq_len]
+    rounding_weight: weight of the probability terms, default config.rounding_weight, updated per batch by dynamic rounding weight
+    generator: CPU torch.Generator drawing the classifier free guidance mask, default global random state
+
+    NOTE: seq_len is max_length, or the batch's longest caption when bucket_by_length
+
+  return triple loss terms
+  '''
+  loss_func = LOSS_FUNCS[config.loss_func]
+  if rounding_weight is None:
+    rounding_weight = config.rounding_weight
+  seq_len = mask.shape[-1]
+  assert seq_len <= config.max_length
+  assert x_t.shape == (config.sample_size * config.batch_size, seq_len, config.in_channel)
+  assert x_1.shape == x_0.shape == (config.batch_size, seq_len, config.in_channel)
+  assert image_clip.shape == text_clip.shape == (config.batch_size, 512)
+  assert mask.shape == (config.batch_size, seq_len)
+  assert idx.shape == (config.batch_size, seq_len)
+  
+  repeat_shape = (config.sample_size, *(1, ) * (len(x_t.shape) - 1))
+  image_clip = image_clip.unsqueeze(1) # shape [ batch_size, 1, clip_dim]
+  text_clip = text_clip.unsqueeze(1) # shape same as above
+
+  if config.classifier_free_weight > 0:
+    classifier_mask = (torch.rand((config.sample_size * config.batch_size, 1), generator=generator) > config.classifier_free_prob).type(torch.float32).to(device)
+    classifier_mask[0] = 0
+    classifier_mask[1] = 1 # prevent no sample or all sample use classifier
+    concat_mask = torch.hstack([torch.ones((config.sample_size * config.batch_size, 1), device=device), classifier_mask])
+  else:
+    concat_mask = torch.tensor([1, 0], device=device).repeat((config.sample_size * config.batch_size, 1))
+
+  # x_t restore loss
+  x_t_prob, x_t_hidden = model(x_t, image_clip.repeat(repeat_shape), text_clip.repeat(repeat_shape), mask.repeat((config.sample_size, 1)), concat_mask, packed=config.bucket_by_length)
+  if config.use_x_t_loss:
+    if config.x_0_prediction:
+      x_t_loss = loss_func(x_t_hidden[:, :seq_len, :], x_0.repeat(repeat_shape), config.batch_size)
+    else:
+      assert x_tgt.shape == x_t.shape
+      x_t_loss = loss_func(x_t_hidden[:, :seq_len, :], x_tgt, config.batch_size)
+  else:
+    x_t_loss = 0
+
+  # x_1 restore loss
+  x_1_prob, x_1_hidden = model(x_1, image_clip, text_clip, mask, torch.tensor([1, 0], device=device).repeat((config.batch_size, 1)), packed=config.bucket_by_length)
+  if config.use_x_1_loss:
+    x_1_loss = loss_func(x_1_hidden[:, :seq_len, :], x_0, config.batch_size)
+  else:
+    x_1_loss = 0
+
+  if config.use_prob_loss:
+    # output sequence probability loss, applied to both x_1 and x_t restore
+    if getattr(model, "vocab_map", None) is not None:
+      # lm_head is restricted, target tokenizer ids to lm_head output index
+      idx = model.vocab_map[idx]
+    # when bucket_by_length, padded positions are not projected onto vocabulary and add nothing to rounding loss
+    x_t_log_prob = token_log_prob(x_t_prob, idx.repeat((config.sample_size, 1)), mask.repeat((config.sample_size, 1)))
+    x_1_log_prob = token_log_prob(x_1_prob, idx, mask)
+    if loss_func == series_sum_sample_mean or loss_func == mse_series_mean:
+      x_t_prob_loss = -x_t_log_prob.sum(dim=1).mean()
+      x_1_prob_loss = -x_1_log_prob.sum(dim=1).mean()
+    else:
+      x_t_prob_loss = -x_t_log_prob.sum() / config.batch_size
+      x_1_prob_loss = -x_1_log_prob.sum() / config.batch_size
+  else:
+    x_t_prob_loss = 0
+    x_1_prob_loss = 0
+  
+  return x_t_loss, x_1_loss, rounding_weight * (x_t_prob_loss + x_1_prob_loss)
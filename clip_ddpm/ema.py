@@ -0,0 +1,84 @@
+'''
+exponential moving average of DistilBertModel trainable parameters, carried in checkpoints as model.ema
+'''
+
+import torch
+
+class ExponentialMovingAverage():
+  '''
+  EMA shadow of model.named_parameters(), updated in place with multi-tensor ops every update_interval optimizer steps.
+  When on_host, shadow is kept in CPU memory, trading host transfer for accelerator memory: CUDA parameters are copied
+  into pinned staging buffers without blocking the training stream and folded into the shadow at the next update,
+  or when the EMA weights are read (copy_to) or pickled
+  '''
+  def __init__(self, model, decay, on_host=False, update_interval=1) -> None:
+    self.decay = decay
+    self.on_host = on_host
+    self.update_interval = update_interval
+    self.step_num = 0
+    self.names = []
+    self.shadow = []
+    for name, p in model.named_parameters():
+      self.names.append(name)
+      self.shadow.append(self.to_shadow_device(p.detach()).clone())
+    self.staging = None # pinned host buffers of the last asynchronous copy of parameters
+    self.pending = None # CUDA event recorded after that copy, None when staging is folded into shadow
+
+  def to_shadow_device(self, tensor):
+    return tensor.cpu() if self.on_host else tensor
+
+  def __getstate__(self):
+    # pickled shadow includes every update, CUDA event and staging buffers are not pickled
+    self.flush()
+    return dict(self.__dict__, staging=None, pending=None)
+
+  def __setstate__(self, state):
+    # EMAs pickled before asynchronous host updates have no staging
+    self.__dict__.update(staging=None, pending=None)
+    self.__dict__.update(state)
+
+  def blend(self, params):
+    decay = self.decay ** self.update_interval
+    torch._foreach_mul_(self.shadow, decay)
+    torch._foreach_add_(self.shadow, params, alpha=1 - decay)
+
+  def flush(self):
+    '''
+    fold the parameters staged by the last update into shadow, waiting for their copy to finish
+    '''
+    if self.pending is None:
+      return
+    self.pending.synchronize()
+    self.pending = None
+    self.blend(self.staging)
+
+  @torch.no_grad()
+  def update(self, model):
+    '''
+    called after each optimizer step, shadow = decay^k * shadow + (1 - decay^k) * parameters every k = update_interval steps
+    '''
+    self.step_num += 1
+    if not self.step_num % self.update_interval == 0:
+      return
+    params = [p.detach() for _, p in model.named_parameters()]
+    if not (self.on_host and params[0].is_cuda):
+      self.blend(params)
+      return
+    # the previous copy finished during the steps since, folding it does not stall
+    self.flush()
+    if self.staging is None:
+      self.staging = [torch.empty_like(shadow).pin_memory() for shadow in self.shadow]
+    for buffer, p in zip(self.staging, params):
+      buffer.copy_(p, non_blocking=True)
+    self.pending = torch.cuda.Event()
+    self.pending.record()
+
+  @torch.no_grad()
+  def copy_to(self, model):
+    '''
+    overwrite model parameters with the EMA weights
+    '''
+    self.flush()
+    params = dict(model.named_parameters())
+    for name, shadow in zip(self.names, self.shadow):
+      params[name].copy_(shadow)
@@ -0,0 +1,264 @@
+'''
+eval command: qualitative denoising trace and BLEU-4 of a trained checkpoint on its validation split,
+optional inference graph, rounding and int8 quantization reports, results are appended to {model_name}.txt in output_dir
+'''
+
+import argparse
+import collections
+import itertools
+import os
+import sys
+import time
+
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+from . import data
+from .diffusion import diffuse_t
+from .config import add_config_arguments, config_from_args
+from .model import load_checkpoint
+from .shards import load_shard, read_index
+from .sampling import (
+  to_vocab_ids, NearestEmbeddingIndex, benchmark_rounding, make_denoise_step, sample, sample_early_exit,
+  check_parity, benchmark_denoise_step, calibrate_quantization, ClipCaptionScorer, rerank_candidates
+)
+from .utils import get_device
+
+device = get_device()
+
+def trace_inference(config, model, tokenizer, item, summary):
+  '''
+  write the denoising trace of validation caption item from t = 999, and its restoration from increasing t
+  '''
+  with torch.no_grad():
+
+    summary.write(f"origin text: {item['text']}\n")
+
+    item = {key: value.to(device) if torch.is_tensor(value) else value for key, value in item.items()}
+    image_clip = item["image_clip"][None, None, :]
+    text_clip = item["text_clip"][None, None, :]
+
+    x_0 = model.embedding(item["input_ids"].unsqueeze(0))
+    t = 999
+    summary.write(f"t = {t}\n")
+    x_t = diffuse_t(config, x_0, torch.tensor([t], dtype=torch.int64, device=device))
+    mask = item["attention_mask"].unsqueeze(0)
+
+    # multi-step inference
+    restored = x_t
+    for i in range(10):
+      out, restored = model(restored[:, :config.max_length, :], image_clip, text_clip, mask, torch.tensor([1, 0], device=device).repeat(mask.shape[0], 1))
+      summary.write(f"inferred: {tokenizer.decode(to_vocab_ids(model, out.argmax(dim=-1))[0])}\n")
+
+    # effectiveness of model on large t
+    summary.write("text t effectiveness\n")
+    for i in range(1, config.step_tot, 100):
+      x_t = diffuse_t(config, x_0, torch.tensor([i], dtype=torch.int64, device=device))
+      out, _ = model(x_t, image_clip, text_clip, mask, torch.tensor([1, 0], device=device).repeat(mask.shape[0], 1))
+
+      summary.write(f"t: {i} restore: {tokenizer.decode(to_vocab_ids(model, out.argmax(dim=-1))[0])}\n")
+
+def reference_caption(caption):
+  return '[CLS] ' + caption.strip().lower() + ' [SEP]'
+
+def reference_captions(dataset):
+  '''
+  all reference captions of each image, in dataset row order
+  '''
+  return {image_name: [reference_caption(caption) for caption in captions] for image_name, captions in dataset.data.groupby("image")["caption"]}
+
+def shard_reference_captions(path):
+  '''
+  all reference captions of each image of shard directory path, in row order, read one shard at a time
+  '''
+  references = collections.defaultdict(list)
+  for shard in read_index(path)["shards"]:
+    arrays = load_shard(path, shard["file"])
+    for image_name, caption in zip(arrays["image_names"], arrays["captions"]):
+      references[str(image_name)].append(reference_caption(str(caption)))
+  return dict(references)
+
+def image_loader(config, dataset, subset):
+  '''
+  loader over the first caption row of each distinct image in subset, for per image evaluation
+  '''
+  images = dataset.data["image"].iloc[list(subset.indices)]
+  return DataLoader(torch.utils.data.Subset(dataset, images.drop_duplicates().index.tolist()), shuffle=False, batch_size=config.batch_size)
+
+def evaluate_bleu(config, step, model, tokenizer, loader, references, summary, steps=None, max_batches=None, rounding_index=None, clamp_index=None, early_exit=False, candidate_num=1, scorer=None, corpus=False):
+  '''
+  return (average BLEU-4 over batches of loader, or corpus BLEU-4 over all of it if corpus, generated tokens per second)
+    references: reference_captions of the dataset
+    rounding_index: NearestEmbeddingIndex used to decode instead of lm_head argmax
+    clamp_index: NearestEmbeddingIndex used to clamp intermediate predictions in sampling
+    early_exit: if sample_early_exit is used, average passes per caption is written to summary
+    candidate_num, scorer: captions sampled per image in the same batch, and ClipCaptionScorer choosing the best one
+  steps defaults to config.sample_steps
+  '''
+  from torchmetrics import BLEUScore
+
+  steps = config.sample_steps if steps is None else steps
+  metric = BLEUScore()
+  acc_bleu = 0
+  batch_num = 0
+  token_num = 0
+  sample_time = 0
+  acc_passes = 0
+  sequence_num = 0
+  corpus_metric = BLEUScore()
+  with torch.no_grad():
+  # with tqdm.tqdm(loader, unit="batch") as tepoch:
+  #   for j, x in enumerate(tepoch):
+    for j, x in enumerate(loader):
+      if max_batches is not None and j >= max_batches:
+        break
+
+      # each prediction involves multiple generation steps
+      start = time.perf_counter()
+      image_clip = x["image_clip"].to(device).unsqueeze(1).repeat_interleave(candidate_num, dim=0)
+      if early_exit:
+        out, restored, passes = sample_early_exit(config, step, image_clip, steps, clamp_index)
+        acc_passes += passes.sum().item()
+        sequence_num += passes.numel()
+      else:
+        out, restored = sample(config, step, image_clip, steps, clamp_index)
+
+      # append final strings to each answer bin
+      if rounding_index is None:
+        indexes = to_vocab_ids(model, nn.functional.softmax(out, dim=-1).argmax(dim=-1))
+      else:
+        indexes = rounding_index.search(restored[:, :config.max_length, :])[0][..., 0]
+      if candidate_num > 1:
+        indexes = rerank_candidates(indexes, image_clip, scorer, candidate_num, tokenizer)
+      sample_time += time.perf_counter() - start
+      token_num += indexes.numel()
+      indexes = indexes.unique_consecutive(dim=-1)
+
+      ans_strs = [tokenizer.decode(index) for index in indexes]
+
+      GT_list = [references[image_name] for image_name in x["image"]]
+
+      acc_bleu += metric(ans_strs, GT_list)
+      corpus_metric.update(ans_strs, GT_list)
+      batch_num += 1
+
+  if early_exit:
+    summary.write(f"early exit: {acc_passes / sequence_num:.2f} of {steps} passes per sampled caption on average\n")
+  if corpus:
+    return corpus_metric.compute(), token_num / sample_time
+  return acc_bleu / batch_num, token_num / sample_time
+
+def nearest_embedding_indexes(config, model):
+  '''
+  return (rounding_index, clamp_index) NearestEmbeddingIndex of config rounding_method and clamp_method, None when not used
+  '''
+  rounding_index = None if config.rounding_method == "lm_head" else NearestEmbeddingIndex(model, seq_len=config.max_length, method=config.rounding_method, nprobe=config.ivfpq_nprobe)
+  if config.clamp_method is None:
+    clamp_index = None
+  elif config.clamp_method == config.rounding_method:
+    clamp_index = rounding_index
+  else:
+    clamp_index = NearestEmbeddingIndex(model, seq_len=config.max_length, method=config.clamp_method, nprobe=config.ivfpq_nprobe)
+  return rounding_index, clamp_index
+
+def run(config, checkpoint=None, valset=None):
+  '''
+  evaluate the checkpoint trained with config, default {model_name}.pickle and .split in output_dir, return its BLEU-4.
+  Runs trained on config.shard_dir are evaluated on the validation shards of data.split_shards, streamed, valset is not used
+  '''
+  if config.shard_dir is None:
+    dataset = data.load_dataset(config)
+    val_set = data.load_val_set(config, dataset, valset)
+    val_loader = data.make_loader(config, dataset, val_set, shuffle=False)
+    val_items = lambda: (val_set[i] for i in range(len(val_set)))
+    references = reference_captions(dataset)
+  else:
+    # per image evaluation picks rows of the source dataset, which a shard run does not load
+    assert not config.evaluate_per_image, "evaluate_per_image is not supported with shard_dir"
+    _, val_shards = data.split_shards(config)
+    val_loader = data.make_stream_loader(config, val_shards, shuffle=False)
+    val_items = lambda: iter(val_loader.dataset)
+    references = shard_reference_captions(config.shard_dir)
+  tokenizer = data.load_tokenizer(config)
+
+  summary = open(config.path(".txt"), "a")
+  # summary = sys.stdout
+
+  # trial on inference
+  model = load_checkpoint(config, checkpoint, ema=config.use_ema)
+  # model.model.add_module("activation", activations.GELUActivation())
+  model.eval()
+  trace_inference(config, model, tokenizer, next(val_items()), summary)
+
+  if config.benchmark_inference:
+    for graph in [None, "static", "torchscript", "compile", "onnxruntime"]:
+      try:
+        step = make_denoise_step(model, graph, config.batch_size, onnx_path=config.resolved_onnx_path())
+        step_time = benchmark_denoise_step(config, step)
+      except ImportError as e:
+        # onnxruntime and the compile backend are optional
+        summary.write(f"inference graph {graph}: skipped, {e}\n")
+        continue
+      summary.write(f"inference graph {graph}: {step_time * 1000:.2f} ms per step, batch size {config.batch_size}\n")
+
+  denoise_step = make_denoise_step(model, config.inference_graph, config.batch_size, onnx_path=config.resolved_onnx_path())
+  if config.inference_graph is not None:
+    token_agreement, max_diff = check_parity(config, denoise_step, make_denoise_step(model, None), next(iter(val_loader))["image_clip"].to(device).unsqueeze(1))
+    summary.write(f"inference graph {config.inference_graph} parity with pytorch: {token_agreement * 100:.2f}% identical tokens, max logit difference {max_diff}\n")
+
+  rounding_index, clamp_index = nearest_embedding_indexes(config, model)
+  if config.benchmark_rounding:
+    with torch.no_grad():
+      _, feature_out = sample(config, denoise_step, next(iter(val_loader))["image_clip"].to(device).unsqueeze(1))
+    for method in ["exact", "ivfpq"]:
+      try:
+        index = NearestEmbeddingIndex(model, seq_len=config.max_length, method=method, nprobe=config.ivfpq_nprobe)
+      except ImportError as e:
+        # ivfpq needs the optional faiss
+        summary.write(f"rounding {method} nearest embedding: skipped, {e}\n")
+        continue
+      lm_head_time, index_time, token_agreement = benchmark_rounding(model, index, feature_out[:, :config.max_length, :])
+      summary.write(f"rounding lm_head: {lm_head_time * 1000:.2f} ms, {method} nearest embedding: {index_time * 1000:.2f} ms, {token_agreement * 100:.2f}% identical tokens\n")
+
+  # candidate reranking decodes with the pretrained DistilBERT tokenizer
+  assert config.candidate_num == 1 or not config.train_embedding
+  scorer = ClipCaptionScorer(config) if config.candidate_num > 1 else None
+  if config.evaluate_per_image:
+    val_image_loader = image_loader(config, dataset, val_set)
+    bleu, _ = evaluate_bleu(config, denoise_step, model, tokenizer, val_image_loader, references, summary, rounding_index=rounding_index, clamp_index=clamp_index, early_exit=config.early_exit, candidate_num=config.candidate_num, scorer=scorer, corpus=True)
+    # per caption row evaluation would caption every row of val_loader
+    row_num, image_num = len(val_loader) * config.batch_size, len(val_image_loader.dataset)
+    summary.write(f"per image evaluation: {image_num} images instead of {row_num} caption rows, "
+                  f"{(row_num - image_num) * config.sample_steps * config.candidate_num} sequence forward passes "
+                  f"({(len(val_loader) - len(val_image_loader)) * config.sample_steps} batched passes) saved\n")
+    summary.write(f"BLEU-4 score (corpus, per image): {bleu}")
+  else:
+    bleu, _ = evaluate_bleu(config, denoise_step, model, tokenizer, val_loader, references, summary, rounding_index=rounding_index, clamp_index=clamp_index, early_exit=config.early_exit, candidate_num=config.candidate_num, scorer=scorer)
+    summary.write(f"BLEU-4 score: {bleu}")
+
+  if config.quantization_report:
+    # calibration uses the same cached validation features across runs of this trial
+    calibration_path = config.path(".calibration.pt")
+    if os.path.exists(calibration_path):
+      calibration_clip = torch.load(calibration_path).to(device)
+    else:
+      calibration_clip = torch.stack([item["image_clip"] for item in itertools.islice(val_items(), config.quantization_calibration_size)]).to(device).unsqueeze(1)
+      torch.save(calibration_clip.cpu(), calibration_path)
+    quantize_skip = calibrate_quantization(model, calibration_clip, config.quantization_tolerance)
+    summary.write(f"\nint8 quantization keeps fp32: {quantize_skip}\n")
+    for graph in ["cpu", "int8_cpu"]:
+      report_bleu, tokens_per_sec = evaluate_bleu(config, make_denoise_step(model, graph, quantize_skip=quantize_skip), model, tokenizer, val_loader, references, summary, max_batches=config.quantization_report_batches)
+      summary.write(f"{graph}: BLEU-4 {report_bleu}, {tokens_per_sec:.1f} tokens/sec\n")
+
+  if not summary == sys.stdout:
+    summary.close()
+  return bleu
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m clip_ddpm eval", description=__doc__.strip())
+  add_config_arguments(parser)
+  parser.add_argument("--checkpoint", default=None, help="pickled model, default {model_name}.pickle in output_dir")
+  parser.add_argument("--valset", default=None, help="split manifest directory saved by train or legacy .valset file, default {model_name}.split in output_dir, not used with --shard-dir")
+  args = parser.parse_args(argv)
+  return run(config_from_args(args), args.checkpoint, args.valset)
@@ -0,0 +1,84 @@
+'''
+extract command: CLIP image and text features of a caption file, saved as the per caption row pickles read by training
+  (image_features and text_features of a RunConfig source), CLIP is loaded from clip_processor_path and clip_path of the run config
+'''
+
+import argparse
+import functools
+import os
+
+import pandas as pd
+import torch
+from torch import nn
+
+from .config import add_config_arguments, config_from_args
+from .data import read_captions
+from .utils import get_device
+
+device = get_device()
+
+@functools.lru_cache(maxsize=None)
+def load_clip(processor_path, model_path):
+  '''
+  return (processor, model) of the local CLIP ViT-B/32
+  '''
+  from transformers import CLIPProcessor, CLIPModel as CLIP
+
+  clip_processor = CLIPProcessor.from_pretrained(processor_path)
+  clip = CLIP.from_pretrained(model_path).to(device).eval()
+  return clip_processor, clip
+
+def image_features(config, images, batch_size=64):
+  '''
+  return L2 normalized CLIP image features of PIL images, shape [image_num, clip_dim]
+  '''
+  clip_processor, clip = load_clip(config.clip_processor_path, config.clip_path)
+  features = []
+  with torch.no_grad():
+    for start in range(0, len(images), batch_size):
+      inputs = clip_processor(text="", images=images[start:start + batch_size], return_tensors="pt", padding=True)
+      features.append(clip.get_image_features(pixel_values=inputs["pixel_values"].to(device)))
+  return nn.functional.normalize(torch.vstack(features), dim=-1)
+
+def text_features(config, captions, batch_size=256):
+  '''
+  return L2 normalized CLIP text features of caption strings, shape [caption_num, clip_dim]
+  '''
+  clip_processor, clip = load_clip(config.clip_processor_path, config.clip_path)
+  features = []
+  with torch.no_grad():
+    for start in range(0, len(captions), batch_size):
+      inputs = clip_processor(text=captions[start:start + batch_size], return_tensors="pt", padding=True, truncation=True).to(device)
+      features.append(clip.get_text_features(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"]))
+  return nn.functional.normalize(torch.vstack(features), dim=-1)
+
+def extract(config, captions_path, image_dir, image_out, text_out, batch_size=64):
+  '''
+  write CLIP features of every caption row of captions_path, images in image_dir are encoded once each
+  '''
+  from PIL import Image
+
+  data = read_captions(captions_path)
+  image_codes, image_names = pd.factorize(data["image"])
+  image_set = []
+  for start in range(0, len(image_names), batch_size):
+    images = [Image.open(os.path.join(image_dir, name)).convert("RGB") for name in image_names[start:start + batch_size]]
+    image_set.append(image_features(config, images, batch_size))
+  image_set = torch.vstack(image_set)[torch.from_numpy(image_codes).to(device)]
+  text_set = text_features(config, [str(caption).strip() for caption in data["caption"]])
+
+  torch.save(image_set.cpu(), image_out)
+  torch.save(text_set.cpu(), text_out)
+  print(f"{len(data)} caption rows of {len(image_names)} images written to {image_out}, {text_out}")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m clip_ddpm extract", description=__doc__.strip())
+  parser.add_argument("captions", help="captions.txt of flickr8k, captions.csv of flickr30k or COCO captions json")
+  parser.add_argument("images", help="directory of the images named in captions")
+  parser.add_argument("--image-out", required=True, help="output pickle of image features, one row per caption")
+  parser.add_argument("--text-out", required=True, help="output pickle of caption text features")
+  parser.add_argument("--extract-batch-size", type=int, default=64, help="images per CLIP forward pass")
+  add_config_arguments(parser)
+  args = parser.parse_args(argv)
+
+  extract(config_from_args(args), args.captions, args.images, args.image_out, args.text_out, args.extract_batch_size)
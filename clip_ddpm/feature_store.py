@@ -0,0 +1,111 @@
+'''
+store command: converts the CLIP feature pickles into one memory-mapped array per modality with an id index,
+so training, evaluation and worker processes map the same files read-only instead of each loading and stacking the pickles,
+used by runs with --feature-store
+'''
+
+import argparse
+import json
+import os
+import warnings
+
+import numpy as np
+import torch
+
+from .config import add_config_arguments, config_from_args
+from .utils import manifest_directory
+
+MODALITIES = ["image", "text"]
+
+def convert(sources, path, dtype="float16"):
+  '''
+  inputs:
+    sources: list of (name, image pickle path, text pickle path), rows are stacked in this order
+    path: output directory, holds image.npy, text.npy and index.json
+    dtype: "float16" or "float32" storage type
+  '''
+  with manifest_directory(path, "index.json") as index:
+    features = {modality: [] for modality in MODALITIES}
+    index.update({"dtype": dtype, "sources": []})
+    start = 0
+    for name, image_path, text_path in sources:
+      image = torch.load(image_path, map_location="cpu").detach().float()
+      text = torch.load(text_path, map_location="cpu").detach().float()
+      assert image.shape[0] == text.shape[0], f"{name}: {image.shape[0]} image rows but {text.shape[0]} text rows"
+      features["image"].append(image)
+      features["text"].append(text)
+      index["sources"].append({"name": name, "start": start, "length": image.shape[0], "image": image_path, "text": text_path})
+      start += image.shape[0]
+
+    for modality in MODALITIES:
+      stacked = torch.vstack(features[modality]).numpy()
+      array = np.lib.format.open_memmap(os.path.join(path, f"{modality}.npy"), mode="w+", dtype=dtype, shape=stacked.shape)
+      array[:] = stacked
+      array.flush()
+      del array
+    index["length"] = start
+
+class FeatureStore():
+  '''
+  read-only memory-mapped view of a converted feature store,
+  image and text are arrays of shape [length, clip_dim] shared through the page cache by every process mapping them
+  '''
+  def __init__(self, path) -> None:
+    with open(os.path.join(path, "index.json")) as f:
+      self.index = json.load(f)
+    self.image = np.load(os.path.join(path, "image.npy"), mmap_mode="r")
+    self.text = np.load(os.path.join(path, "text.npy"), mmap_mode="r")
+    assert len(self.image) == len(self.text) == self.index["length"]
+
+  def __len__(self):
+    return self.index["length"]
+
+  @property
+  def sources(self):
+    return [source["name"] for source in self.index["sources"]]
+
+  def rows(self, name):
+    '''
+    return slice of the rows coming from source name
+    '''
+    for source in self.index["sources"]:
+      if source["name"] == name:
+        return slice(source["start"], source["start"] + source["length"])
+    raise KeyError(name)
+
+  def tensors(self, names=None):
+    '''
+    return (image, text) torch tensors sharing memory with the mapped files, restricted to sources in names if given
+    NOTE: tensors are not writable, storage dtype is kept, cast batches to float32 before use
+    '''
+    image, text = self.image, self.text
+    if names is not None:
+      rows = [self.rows(name) for name in names]
+      if not all(a.stop == b.start for a, b in zip(rows[:-1], rows[1:])):
+        # non adjacent sources cannot be a view
+        image = np.concatenate([self.image[r] for r in rows])
+        text = np.concatenate([self.text[r] for r in rows])
+      else:
+        image, text = self.image[rows[0].start:rows[-1].stop], self.text[rows[0].start:rows[-1].stop]
+    with warnings.catch_warnings():
+      # torch warns on read-only numpy memory, the tensors are never written to
+      warnings.simplefilter("ignore", UserWarning)
+      return torch.from_numpy(image), torch.from_numpy(text)
+
+def open_store(path):
+  return FeatureStore(path)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m clip_ddpm store", description=__doc__.strip())
+  parser.add_argument("path", help="output directory, passed to train as --feature-store")
+  parser.add_argument("--source", nargs=3, action="append", default=None, metavar=("NAME", "IMAGE_PICKLE", "TEXT_PICKLE"),
+                      help="CLIP feature pickles of one source, repeated for several sources, default the sources of the run config")
+  parser.add_argument("--dtype", default="float16", choices=["float16", "float32"], help="storage type of the features")
+  add_config_arguments(parser)
+  args = parser.parse_args(argv)
+  config = config_from_args(args)
+
+  sources = [(source.name, source.image_features, source.text_features) for source in config.sources] if args.source is None else args.source
+  convert(sources, args.path, args.dtype)
+  store = open_store(args.path)
+  print(f"{len(store)} rows from {store.sources} written to {args.path}")
@@ -0,0 +1,254 @@
+'''
+CLIP-DiffusionLM denoiser: DistilBERT over noised caption embeddings conditioned on CLIP features
+'''
+
+import copy
+
+import torch
+from torch import nn
+
+from .utils import get_device, load
+
+device = get_device()
+
+class DistilBertModel(nn.Module):
+  def __init__(self, run_config, embedding=None, projection=None, config=None, vocab_size=None) -> None:
+    '''
+    inputs:
+      run_config: RunConfig, kept with the model and pickled into checkpoints
+      embedding: clip embedding module
+      config: DistilBertConfig
+      vocab_size: tokenizer vocabulary size, only used when train_embedding
+    '''
+    super().__init__()
+    from transformers import DistilBertForMaskedLM
+
+    self.run_config = run_config
+    self.model = DistilBertForMaskedLM(config).to(device)
+
+    if run_config.train_embedding:
+      self.embedding = nn.Embedding(vocab_size, run_config.in_channel, device=device).requires_grad_(True)
+      self.lm_head = nn.Linear(run_config.in_channel, vocab_size, bias=False, device=device).requires_grad_(True)
+
+      self.input_projection = nn.Linear(run_config.in_channel, 768, device=device).requires_grad_(True)
+      self.output_projection = nn.Linear(768, run_config.in_channel, device=device).requires_grad_(True)
+    else:
+      self.embedding = copy.deepcopy(embedding.requires_grad_(False))
+      self.lm_head = copy.deepcopy(projection.requires_grad_(False))
+      self.lm_head.bias.data = torch.zeros(self.lm_head.bias.data.shape, device=device).requires_grad_(False)
+    
+    self.model.set_input_embeddings(nn.Sequential())
+    self.model.set_output_embeddings(nn.Sequential())
+
+    self.image_linear = nn.Linear(512, 768, device=device)
+    self.text_linear = nn.Linear(512, 768, device=device)
+
+    if run_config.clip_adding_method == "concat":
+      self.segment_embedding = nn.Embedding(2, 768, device=device)
+
+    # set by restrict_vocab, sub_vocab maps lm_head output index to tokenizer id, vocab_map is the inverse
+    self.register_buffer("sub_vocab", None)
+    self.register_buffer("vocab_map", None)
+    # ExponentialMovingAverage of trainable parameters when trained with ema_decay, pickled with the model
+    self.ema = None
+
+  def _apply(self, fn, *args, **kwargs):
+    # EMA shadow on the model device follows it, e.g. to CPU when pickled
+    super()._apply(fn, *args, **kwargs)
+    ema = getattr(self, "ema", None)
+    if ema is not None and not ema.on_host:
+      ema.shadow = [fn(shadow) for shadow in ema.shadow]
+    return self
+
+  def restrict_vocab(self, sub_vocab, unk_id):
+    '''
+    slice lm_head to the tokenizer ids in sub_vocab, 
+    tokenizer ids outside sub_vocab are mapped to the output index of unk_id
+    '''
+    assert self.sub_vocab is None
+    self.sub_vocab = sub_vocab.to(device)
+    self.vocab_map = torch.full((self.lm_head.out_features, ), int((self.sub_vocab == unk_id).nonzero()), dtype=torch.int64, device=device)
+    self.vocab_map[self.sub_vocab] = torch.arange(len(self.sub_vocab), device=device)
+
+    lm_head = nn.Linear(self.lm_head.in_features, len(self.sub_vocab), device=device).requires_grad_(False)
+    lm_head.weight.data = self.lm_head.weight.data[self.sub_vocab].clone()
+    lm_head.bias.data = self.lm_head.bias.data[self.sub_vocab].clone()
+    self.lm_head = lm_head
+
+  def set_gradient_checkpointing(self, enabled):
+    '''
+    recompute activations of each DistilBERT transformer layer in backward instead of storing them, only active in training mode
+    '''
+    if enabled:
+      self.model.gradient_checkpointing_enable()
+    else:
+      self.model.gradient_checkpointing_disable()
+
+  def named_parameters(self, prefix="", recurse=True, remove_duplicate=True):
+    '''
+    trainable parameters only: frozen pretrained embedding and lm_head are left out unless train_embedding
+    '''
+    run_config = self.run_config
+    names = ["model", "image_linear", "text_linear"]
+    if run_config.train_embedding:
+      names += ["embedding", "lm_head", "input_projection", "output_projection"]
+
+    if run_config.clip_adding_method == "concat":
+      names += ["segment_embedding"]
+    elif not run_config.clip_adding_method == "add":
+      raise NotImplementedError(run_config.clip_adding_method)
+    for name in names:
+      yield from getattr(self, name).named_parameters(prefix=f"{prefix}.{name}" if prefix else name, remove_duplicate=remove_duplicate)
+
+  def parameters(self, recurse=True):
+    return [p for _, p in self.named_parameters()]
+
+  def forward(self, x, image_clip, text_clip, mask, concat_mask, packed=False):
+    '''
+    input:
+      x: [x_t ... x_t], shape: [sample_size * batch_size, seq_len, in_channel]
+        NOTE: seq_len is max_length, or the batch's longest caption when bucket_by_length
+      image_clip, text_clip shape: [sample_size * batch_size, 1, clip_dim]
+      mask shape: [sample_size * batch_size, seq_len] 
+      packed: if only non-padding positions are projected onto the vocabulary, set by diffusion.loss when bucket_by_length
+    
+    return 
+      vocab_out, shape: [sample_size * batch_size, seq_len, vocab_size]
+        NOTE: when packed and mask has padding, only non-padding positions are projected,
+        in row-major order of mask, shape [non-padding position num, vocab_size]
+      feature_out, shape: [sample_size * batch_size, seq_len, in_channel]
+    '''
+    run_config = self.run_config
+    sample_batch_multi, seq_len, _ = x.shape
+
+    assert seq_len <= run_config.max_length
+    assert x.shape == (sample_batch_multi, seq_len, run_config.in_channel)
+    assert image_clip.shape == text_clip.shape == (sample_batch_multi, 1, 512)
+    assert mask.shape == (sample_batch_multi, seq_len)
+    assert concat_mask.shape == (sample_batch_multi, 2)
+
+    # mask of which sample is classifier free guided, true if guided
+    guidance_sample_index = (concat_mask[:, 1] == 1)
+
+    if run_config.train_embedding:
+      x = self.input_projection(x)
+    
+    if run_config.clip_adding_method == "concat":
+      classifier_guided_mask = torch.hstack([mask, torch.tensor([1, 1], device=device).repeat(sample_batch_multi, 1)])
+      non_classifier_mask = torch.hstack([mask, torch.tensor([1, 0], device=device).repeat(sample_batch_multi, 1)])
+
+      x = torch.hstack([x, self.image_linear(image_clip), self.text_linear(text_clip)])
+      x = x + self.segment_embedding(torch.tensor([0] * seq_len + [1] * 2, device=device))
+
+      classifier_guided_x = non_classifier_x = x
+    elif run_config.clip_adding_method == "add":
+      classifier_guided_mask = non_classifier_mask = mask
+
+      non_classifier_x = x + self.image_linear(image_clip)
+      classifier_guided_x = non_classifier_x + self.text_linear(text_clip)
+    else:
+      raise NotImplementedError(run_config.clip_adding_method)
+
+    # no classifier guidance part
+    x_out = self.model(non_classifier_x, non_classifier_mask)[0]
+    if run_config.classifier_free_weight > 0 and not guidance_sample_index.sum() == 0:
+      # classifier guided
+      x_out[guidance_sample_index] = \
+        (1 + run_config.classifier_free_weight) * self.model(classifier_guided_x[guidance_sample_index], classifier_guided_mask[guidance_sample_index])[0] \
+        - run_config.classifier_free_weight * x_out[guidance_sample_index]
+    
+    if run_config.train_embedding:
+      x_out = self.output_projection(x_out)
+
+    assert x_out.shape == (sample_batch_multi, non_classifier_mask.shape[-1], run_config.in_channel)
+    if packed and not bool(mask.all()):
+      # only project non-padding positions onto the vocabulary
+      return self.lm_head(x_out[:, :seq_len, :][mask.bool()]), x_out
+    return self.lm_head(x_out[:, :seq_len, :]), x_out
+
+  def inference_module(self, seq_len=None):
+    '''
+    return StaticInferenceModel sharing this model's weights, for fixed shape image-only sampling, seq_len defaults to max_length
+    '''
+    return StaticInferenceModel(self, seq_len or self.run_config.max_length).eval()
+
+class StaticInferenceModel(nn.Module):
+  '''
+  inference-only view of a trained DistilBertModel used in caption sampling: 
+    image clip conditioning only, all-ones caption mask, no classifier free guidance.
+  Constant tensors are registered buffers and hyperparameter branches are resolved at construction, 
+  so forward has no python asserts or global flag lookups and can go through torch.jit.trace, torch.compile or torch.onnx.export
+  NOTE: submodules are shared with the source model but buffers are snapshots, rebuild after further training
+  '''
+  def __init__(self, model, seq_len=None) -> None:
+    super().__init__()
+    run_config = model.run_config
+    self.seq_len = seq_len = seq_len or run_config.max_length
+    self.concat = run_config.clip_adding_method == "concat"
+
+    self.model = model.model
+    self.image_linear = model.image_linear
+    self.lm_head = model.lm_head
+    if run_config.train_embedding:
+      self.input_projection = model.input_projection
+      self.output_projection = model.output_projection
+    else:
+      self.input_projection = nn.Identity()
+      self.output_projection = nn.Identity()
+
+    buffer_device = model.image_linear.weight.device
+    with torch.no_grad():
+      if self.concat:
+        # text clip input is zeros when sampling, text_linear(0) is its bias, slot is masked out in attention
+        self.register_buffer("text_slot", model.text_linear.bias.detach().clone().reshape(1, 1, -1))
+        self.register_buffer("segment_bias", model.segment_embedding(torch.tensor([0] * seq_len + [1] * 2, device=buffer_device)).detach().clone())
+        self.register_buffer("attention_mask", torch.tensor([[1.] * seq_len + [1., 0.]], device=buffer_device))
+      elif run_config.clip_adding_method == "add":
+        self.register_buffer("attention_mask", torch.ones((1, seq_len), device=buffer_device))
+      else:
+        raise NotImplementedError(run_config.clip_adding_method)
+
+  def forward(self, x, image_clip):
+    '''
+    input:
+      x shape: [batch_size, seq_len, in_channel]
+      image_clip shape: [batch_size, 1, clip_dim]
+
+    return same as DistilBertModel.forward
+    '''
+    batch_size = x.shape[0]
+    x = self.input_projection(x)
+    if self.concat:
+      x = torch.cat([x, self.image_linear(image_clip), self.text_slot.expand(batch_size, -1, -1)], dim=1) + self.segment_bias
+    else:
+      x = x + self.image_linear(image_clip)
+
+    x_out = self.model(x, self.attention_mask.expand(batch_size, -1), return_dict=False)[0]
+    x_out = self.output_projection(x_out)
+    return self.lm_head(x_out[:, :self.seq_len, :]), x_out
+
+def build_model(run_config, vocab_size):
+  '''
+  new DistilBertModel, initialised from pretrained DistilBERT embedding and lm_head unless train_embedding
+  '''
+  from transformers import DistilBertForMaskedLM, DistilBertConfig
+
+  configuration = DistilBertConfig()
+  if run_config.train_embedding:
+    return DistilBertModel(run_config, config=configuration, vocab_size=vocab_size)
+  origin = DistilBertForMaskedLM.from_pretrained(run_config.distilbert_path, local_files_only=True).to(device)
+  return DistilBertModel(run_config, origin.get_input_embeddings(), origin.get_output_embeddings(), config=configuration)
+
+def load_checkpoint(run_config, path=None, ema=False):
+  '''
+  trained model pickled at path, default {model_name}.pickle of run_config,
+  models pickled without a run config (by the single file script) are given run_config.
+  When ema, parameters are replaced by the EMA weights the model was trained with, if any, for sampling and evaluation
+  '''
+  model = load(path or run_config.path(".pickle")).to(device)
+  if getattr(model, "run_config", None) is None:
+    model.run_config = run_config
+  if ema and getattr(model, "ema", None) is not None:
+    model.ema.copy_to(model)
+    model.ema = None
+  return model
@@ -0,0 +1,123 @@
+'''
+AdamW construction for DistilBertModel: weight decay param groups, multi-tensor / fused steps and flat parameter buffers
+'''
+
+import time
+
+import torch
+from torch import nn, optim
+
+from .utils import get_device
+
+device = get_device()
+
+OPTIMIZERS = ["adamw", "foreach", "fused", "flat"]
+
+def is_norm_or_bias(name):
+  '''
+  if named parameter is a bias or belongs to a LayerNorm (DistilBERT sa_layer_norm, output_layer_norm, vocab_layer_norm, embeddings.LayerNorm)
+  '''
+  return name.endswith("bias") or "norm" in name.lower()
+
+def param_groups(model, weight_decay, skip_norm_bias=False):
+  '''
+  AdamW param groups of trainable parameters of model, norms and biases in a group without weight decay when skip_norm_bias
+  '''
+  if not skip_norm_bias:
+    return [{"params": list(model.parameters()), "weight_decay": weight_decay}]
+  decay, no_decay = [], []
+  for name, p in model.named_parameters():
+    (no_decay if is_norm_or_bias(name) else decay).append(p)
+  return [{"params": decay, "weight_decay": weight_decay}, {"params": no_decay, "weight_decay": 0.}]
+
+class FlatParameters():
+  '''
+  parameters of each param group copied into one contiguous buffer, parameters and their gradients become views of it,
+  so an optimizer over the flat buffers updates one tensor per group
+  NOTE: module.to / module.cpu replace parameter data and gradients, bind restores the views and keeps the moved values
+  '''
+  def __init__(self, param_groups) -> None:
+    self.groups = [] # (params, flat parameter) of each group
+    for group in param_groups:
+      params = group["params"]
+      assert len({(p.dtype, p.device) for p in params}) == 1, "flat buffer parameters must share dtype and device"
+      flat = nn.Parameter(torch.cat([p.detach().reshape(-1) for p in params]))
+      flat.grad = torch.zeros_like(flat)
+      self.groups.append((params, flat))
+    self.bind()
+
+  def bind(self):
+    with torch.no_grad():
+      for params, flat in self.groups:
+        offset = 0
+        for p in params:
+          view = flat[offset:offset + p.numel()].view_as(p)
+          if not p.data_ptr() == view.data_ptr():
+            view.copy_(p)
+            p.data = view
+          # gradients accumulate in place into the flat gradient
+          p.grad = flat.grad[offset:offset + p.numel()].view_as(p)
+          offset += p.numel()
+
+class FlatAdamW(optim.AdamW):
+  '''
+  AdamW stepping over FlatParameters of param_groups, one multi-tensor update per group
+  '''
+  def __init__(self, param_groups, **kwargs) -> None:
+    self.flat = FlatParameters(param_groups)
+    super().__init__([dict(group, params=[flat]) for group, (_, flat) in zip(param_groups, self.flat.groups)], **kwargs)
+
+  def zero_grad(self, set_to_none=False):
+    # gradients are views of the flat gradients, they are zeroed in place and never set to None
+    self.flat.bind()
+    for _, flat in self.flat.groups:
+      flat.grad.zero_()
+
+def build_optimizer(config, model, lr=None, kind=None):
+  '''
+  AdamW over trainable parameters of model, kind defaults to config.optimizer:
+    "adamw": torch default implementation, "foreach": multi-tensor, "fused": fused CUDA kernel,
+    "flat": over parameters flattened into one contiguous buffer per param group
+  '''
+  lr = config.learning_rate if lr is None else lr
+  kind = kind or config.optimizer
+  groups = param_groups(model, config.weight_decay, config.weight_decay_skip_norm_bias)
+  if kind == "adamw":
+    return optim.AdamW(groups, lr=lr)
+  if kind == "foreach":
+    return optim.AdamW(groups, lr=lr, foreach=True)
+  if kind == "fused":
+    return optim.AdamW(groups, lr=lr, fused=True)
+  if kind == "flat":
+    return FlatAdamW(groups, lr=lr, foreach=True)
+  raise NotImplementedError(kind)
+
+def benchmark_optimizers(config, model, warmup=5, repeat=50):
+  '''
+  return report lines of average optimizer step time of each kind on random gradients, "fused" only on CUDA
+  NOTE: optimizers have learning rate 0, weights are unchanged
+  '''
+  lines = []
+  for kind in OPTIMIZERS:
+    if kind == "fused" and not device.type == "cuda":
+      continue
+    trainer = build_optimizer(config, model, lr=0, kind=kind)
+    trainer.zero_grad()
+    with torch.no_grad():
+      for p in model.parameters():
+        if p.grad is None:
+          p.grad = torch.randn_like(p)
+        else:
+          p.grad.normal_()
+    for _ in range(warmup):
+      trainer.step()
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+      trainer.step()
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+    lines.append(f"optimizer {kind}: {(time.perf_counter() - start) / repeat * 1000:.2f} ms per step, {sum(len(group['params']) for group in trainer.param_groups)} tensors\n")
+  model.zero_grad(set_to_none=True)
+  return lines
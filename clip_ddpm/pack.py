@@ -0,0 +1,104 @@
+'''
+pack command: packs caption files and their CLIP feature pickles into a sharded dataset directory (layout in clip_ddpm/shards.py)
+streamed by training with --shard-dir. Captions and feature rows are checked to be aligned, then shards of shard_size rows
+are tokenized with the run config tokenizer and written by parallel worker processes, rows keep the order of the sources
+'''
+
+import argparse
+import concurrent.futures
+import dataclasses
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+
+from . import data
+from .config import DataSource, add_config_arguments, config_from_args
+from .shards import SHARD_VERSION, tokenizer_name
+from .utils import atomic_write, manifest_directory
+
+def check_alignment(source, captions, image_set, text_set, tolerance=1e-3):
+  '''
+  raise ValueError unless the captions and both feature pickles of source have the same number of rows and,
+  when tolerance is not None, caption rows of the same image have the same CLIP image feature, which rows shifted against the captions break
+  '''
+  if not len(captions) == len(image_set) == len(text_set):
+    raise ValueError(f"{source.name}: {len(captions)} caption rows in {source.captions}, "
+                     f"{len(image_set)} rows in {source.image_features}, {len(text_set)} rows in {source.text_features}")
+  if tolerance is None:
+    return
+  image_codes, _ = pd.factorize(captions["image"])
+  first_rows = torch.from_numpy(np.unique(image_codes, return_index=True)[1][image_codes])
+  difference = (image_set - image_set[first_rows]).abs().amax(dim=-1)
+  if difference.max() > tolerance:
+    row = int(difference.argmax())
+    raise ValueError(f"{source.name}: caption row {row} of image {captions['image'].iloc[row]} has a CLIP image feature differing by "
+                     f"{float(difference[row])} from the first caption row of the image, captions and features are not aligned")
+
+def write_shard(config, path, file, captions, image_names, image, text):
+  '''
+  tokenize captions and write one shard, under a temporary name until complete, return (file, rows)
+  '''
+  input_ids, lengths = data.tokenize_captions(data.load_tokenizer(config), captions, config.max_length)
+  with atomic_write(os.path.join(path, file)) as f:
+    np.savez(f, image=image, text=text, input_ids=input_ids, lengths=lengths,
+             captions=np.asarray(captions, dtype=str), image_names=np.asarray(image_names, dtype=str))
+  return file, len(captions)
+
+def pack(config, sources, path, shard_size=16384, workers=0, image_tolerance=1e-3):
+  '''
+  inputs:
+    sources: DataSource list, rows are stacked in this order, shards do not span sources
+    path: output shard directory, holds shard-XXXXX.npz and index.json
+    workers: processes tokenizing and writing shards, 0 writes them in this process
+    image_tolerance: see check_alignment, None skips the image check for sources with per caption image features
+  return index of the written directory
+  '''
+  with manifest_directory(path, "index.json") as index:
+    index.update({"version": SHARD_VERSION, "tokenizer": tokenizer_name(config), "max_length": config.max_length, "clip_dim": None, "sources": [], "shards": []})
+    pool = concurrent.futures.ProcessPoolExecutor(workers) if workers > 0 else None
+    futures = []
+    start = 0
+    for source in sources:
+      captions = data.read_captions(source.captions)
+      image_set = torch.load(source.image_features, map_location="cpu").detach().float()
+      text_set = torch.load(source.text_features, map_location="cpu").detach().float()
+      check_alignment(source, captions, image_set, text_set, image_tolerance)
+      if index["clip_dim"] is None:
+        index["clip_dim"] = image_set.shape[1]
+      assert image_set.shape[1] == text_set.shape[1] == index["clip_dim"], f"{source.name}: CLIP feature dimension differs from the other sources"
+      image_set, text_set = image_set.half().numpy(), text_set.half().numpy()
+      index["sources"].append(dict(dataclasses.asdict(source), start=start, length=len(captions)))
+      start += len(captions)
+
+      for row in range(0, len(captions), shard_size):
+        rows = slice(row, row + shard_size)
+        args = (config, path, f"shard-{len(futures):05d}.npz", list(captions["caption"].iloc[rows]), list(captions["image"].iloc[rows]), image_set[rows], text_set[rows])
+        futures.append((source.name, pool.submit(write_shard, *args) if pool is not None else write_shard(*args)))
+
+    for source_name, future in futures:
+      file, length = future.result() if pool is not None else future
+      index["shards"].append({"file": file, "length": length, "source": source_name})
+    if pool is not None:
+      pool.shutdown()
+    index["length"] = start
+  return index
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m clip_ddpm pack", description=__doc__.strip())
+  parser.add_argument("out", help="shard directory, passed to train as --shard-dir")
+  parser.add_argument("--source", nargs=4, action="append", default=None, metavar=("NAME", "CAPTIONS", "IMAGE_PICKLE", "TEXT_PICKLE"),
+                      help="caption file (flickr8k captions.txt, flickr30k captions.csv or COCO captions json) and its CLIP feature pickles, "
+                      "repeated for several sources, default the sources of the run config")
+  parser.add_argument("--shard-size", type=int, default=16384, help="caption rows per shard")
+  parser.add_argument("--pack-workers", type=int, default=os.cpu_count(), help="worker processes tokenizing and writing shards, 0 packs in this process")
+  parser.add_argument("--image-tolerance", type=float, default=1e-3, help="maximum difference of the CLIP image features of captions of one image, "
+                      "negative skips the check for sources with per caption image features")
+  add_config_arguments(parser)
+  args = parser.parse_args(argv)
+  config = config_from_args(args)
+
+  sources = config.sources if args.source is None else [DataSource(*source) for source in args.source]
+  index = pack(config, sources, args.out, args.shard_size, args.pack_workers, None if args.image_tolerance < 0 else args.image_tolerance)
+  print(f"{index['length']} caption rows of {[source['name'] for source in index['sources']]} packed into {len(index['shards'])} shards in {args.out}")
@@ -0,0 +1,423 @@
+'''
+caption sampling from noise: denoising step graphs (torchscript, torch.compile, onnxruntime, int8), 
+early exit, nearest token embedding rounding and CLIP candidate reranking
+'''
+
+import collections
+import copy
+import math
+import os
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+from .utils import atomic_write, get_device, state_dict_fingerprint
+
+device = get_device()
+
+def to_vocab_ids(model, indexes):
+  '''
+  map argmax indexes over lm_head output back to tokenizer ids, identity unless lm_head is restricted
+  '''
+  sub_vocab = getattr(model, "sub_vocab", None)
+  return indexes if sub_vocab is None else sub_vocab.to(indexes.device)[indexes]
+
+class NearestEmbeddingIndex():
+  '''
+  rounds denoised vectors to the token whose embedding is nearest in L2 distance. 
+  The table holds model.embedding output of every candidate token at every position, so position embedding and LayerNorm of 
+  DistilBERT embedding are accounted for, shape [seq_len, token_num, in_channel]
+    method "exact": matmul top-k over token chunks with cached squared norm table
+    method "ivfpq": approximate search with one faiss IndexIVFPQ per position, for large vocabularies, nprobe of the nlist cells are searched
+  snap replaces vectors with their nearest table entry, used to clamp intermediate predictions in sampling
+  '''
+  def __init__(self, model, token_ids=None, seq_len=None, method="exact", chunk_size=4096, nlist=256, pq_m=16, nprobe=8) -> None:
+    seq_len = seq_len or model.run_config.max_length
+    if token_ids is None:
+      token_ids = model.sub_vocab if getattr(model, "sub_vocab", None) is not None else torch.arange(model.lm_head.out_features)
+    self.token_ids = token_ids.to(device)
+    self.method = method
+    self.chunk_size = chunk_size
+    # half precision table on GPU saves memory, distances are computed in fp32 chunk by chunk
+    self.dtype = torch.float16 if device.type == "cuda" else torch.float32
+
+    was_training = model.embedding.training
+    model.embedding.eval()
+    with torch.no_grad():
+      table = torch.cat([
+        model.embedding(chunk.unsqueeze(1).expand(-1, seq_len)).transpose(0, 1)
+        for chunk in self.token_ids.split(chunk_size)
+      ], dim=1)
+    model.embedding.train(was_training)
+
+    self.table = table.to(self.dtype)
+    if method == "exact":
+      self.norm = (self.table.float() ** 2).sum(dim=-1) # shape [seq_len, token_num]
+    elif method == "ivfpq":
+      import faiss
+      table = table.float().cpu().numpy()
+      # faiss trains each cell on at least 39 points
+      nlist = min(nlist, table.shape[1] // 39)
+      if nlist == 0:
+        raise ValueError(f"{table.shape[1]} tokens are too few for ivfpq, at least 39 are needed, use exact")
+      self.indexes = []
+      for position_table in table:
+        quantizer = faiss.IndexFlatL2(position_table.shape[-1])
+        index = faiss.IndexIVFPQ(quantizer, position_table.shape[-1], nlist, pq_m, 8)
+        index.nprobe = nprobe
+        index.train(position_table)
+        index.add(position_table)
+        self.indexes.append(index)
+    else:
+      raise NotImplementedError(method)
+
+  def search(self, x, k=1):
+    '''
+    input:
+      x shape: [batch_size, seq_len, in_channel]
+
+    return (tokenizer ids, negative squared distance up to a per-vector constant), both of shape [batch_size, seq_len, k]
+    '''
+    table_ids, scores = self.search_table(x, k)
+    return self.token_ids[table_ids], scores
+
+  def snap(self, x):
+    '''
+    return embedding of the nearest token at each position of x, shape and dtype same as x
+    '''
+    table_ids = self.search_table(x, 1)[0][..., 0]
+    positions = torch.arange(x.shape[1], device=device).unsqueeze(0)
+    return self.table[positions, table_ids].to(x.dtype)
+
+  def search_table(self, x, k):
+    '''
+    same as search, returning indexes into table instead of tokenizer ids
+    '''
+    batch_size, seq_len, _ = x.shape
+    if self.method == "ivfpq":
+      ids, scores = [], []
+      queries = x.float().cpu().numpy()
+      for l in range(seq_len):
+        distance, index = self.indexes[l].search(np.ascontiguousarray(queries[:, l, :]), k)
+        ids.append(torch.from_numpy(index))
+        scores.append(-torch.from_numpy(distance))
+      ids = torch.stack(ids, dim=1).to(device).clamp(min=0) # faiss pads missing results with -1
+      return ids, torch.stack(scores, dim=1).to(device)
+
+    x = x.float()
+    best_scores = torch.full((batch_size, seq_len, 0), -math.inf, device=device)
+    best_ids = torch.zeros((batch_size, seq_len, 0), device=device, dtype=torch.int64)
+    for start in range(0, len(self.token_ids), self.chunk_size):
+      # argmin |x - t|^2 == argmax 2 x.t - |t|^2
+      scores = 2 * torch.einsum("bld,lvd->blv", x, self.table[:seq_len, start:start + self.chunk_size].float()) - self.norm[:seq_len, start:start + self.chunk_size]
+      ids = torch.arange(start, start + scores.shape[-1], device=device).expand_as(scores)
+      best_scores, top = torch.cat([best_scores, scores], dim=-1).topk(k, dim=-1)
+      best_ids = torch.cat([best_ids, ids], dim=-1).gather(-1, top)
+    return best_ids, best_scores
+
+def benchmark_rounding(model, index, feature_out, repeat=20):
+  '''
+  return (seconds of lm_head decoding, seconds of index decoding, fraction of identical tokens) on feature_out [batch_size, seq_len, in_channel]
+  '''
+  def timed(decode):
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+      ids = decode()
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat, ids
+
+  with torch.no_grad():
+    lm_head_time, lm_head_ids = timed(lambda: to_vocab_ids(model, nn.functional.softmax(model.lm_head(feature_out), dim=-1).argmax(dim=-1)))
+    index_time, index_ids = timed(lambda: index.search(feature_out)[0][..., 0])
+  return lm_head_time, index_time, (lm_head_ids == index_ids).float().mean().item()
+
+def onnx_export_path(model, path, seq_len=None):
+  '''
+  path with a sha1 of the weights of model and the exported seq_len inserted before the extension, e.g. {model_name}-{sha1[:16]}.onnx,
+  so a retrained or continued checkpoint never runs the export of other weights
+  '''
+  root, extension = os.path.splitext(path)
+  return f"{root}-{state_dict_fingerprint(model, str(seq_len or model.run_config.max_length))[:16]}{extension}"
+
+def export_onnx(model, path, seq_len=None):
+  '''
+  export StaticInferenceModel of model (including lm_head) to ONNX at path, batch size is a dynamic axis.
+  The graph is written with utils.atomic_write, processes exporting concurrently never read a partial graph
+  '''
+  seq_len = seq_len or model.run_config.max_length
+  static_model = model.inference_module(seq_len)
+  example = (torch.randn((1, seq_len, model.run_config.in_channel), device=device), torch.randn((1, 1, 512), device=device))
+  with torch.no_grad(), atomic_write(path) as f:
+    torch.onnx.export(
+      static_model, example, f, 
+      input_names=["x", "image_clip"], output_names=["vocab_out", "feature_out"],
+      dynamic_axes={"x": {0: "batch_size"}, "image_clip": {0: "batch_size"}, "vocab_out": {0: "batch_size"}, "feature_out": {0: "batch_size"}},
+      opset_version=14)
+
+class OnnxDenoiseStep():
+  '''
+  denoising step running an exported model on onnxruntime CPU, same call signature as make_denoise_step result. 
+  Inputs are copied into, and outputs written to, preallocated CPU buffers bound once per batch size with IO binding
+  NOTE: returned tensors are the reused output buffers, they are overwritten by the next call
+  '''
+  def __init__(self, path, num_threads=0) -> None:
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = num_threads # 0 lets onnxruntime decide
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    self.vocab_size = self.session.get_outputs()[0].shape[-1]
+    self.feature_len = self.session.get_outputs()[1].shape[1]
+    self.bindings = dict()
+
+  def bind(self, batch_size, seq_len, in_channel):
+    buffers = {
+      "x": torch.empty((batch_size, seq_len, in_channel)),
+      "image_clip": torch.empty((batch_size, 1, 512)),
+      "vocab_out": torch.empty((batch_size, seq_len, self.vocab_size)),
+      "feature_out": torch.empty((batch_size, self.feature_len, in_channel)),
+    }
+    binding = self.session.io_binding()
+    for name in ["x", "image_clip"]:
+      binding.bind_input(name, "cpu", 0, np.float32, tuple(buffers[name].shape), buffers[name].data_ptr())
+    for name in ["vocab_out", "feature_out"]:
+      binding.bind_output(name, "cpu", 0, np.float32, tuple(buffers[name].shape), buffers[name].data_ptr())
+    self.bindings[batch_size] = (binding, buffers)
+    return self.bindings[batch_size]
+
+  def __call__(self, x, image_clip):
+    batch_size, seq_len, in_channel = x.shape
+    binding, buffers = self.bindings.get(batch_size) or self.bind(batch_size, seq_len, in_channel)
+    buffers["x"].copy_(x)
+    buffers["image_clip"].copy_(image_clip)
+    self.session.run_with_iobinding(binding)
+    return buffers["vocab_out"].to(x.device), buffers["feature_out"].to(x.device)
+
+def quantizable_modules(model):
+  '''
+  names of module groups whose nn.Linear layers can be int8 quantized: each transformer layer, vocab_transform and lm_head
+  '''
+  return [f"model.distilbert.transformer.layer.{i}" for i in range(model.model.config.n_layers)] + ["model.vocab_transform", "lm_head"]
+
+def quantize_model(model, skip=()):
+  '''
+  return CPU copy of model with nn.Linear layers in quantizable_modules dynamically quantized to int8, 
+  groups named in skip stay fp32
+  '''
+  quantized = copy.deepcopy(model).cpu().eval()
+  qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name in quantizable_modules(model) if name not in skip}
+  return torch.ao.quantization.quantize_dynamic(quantized, qconfig_spec, dtype=torch.qint8)
+
+def calibrate_quantization(model, image_clip, tolerance=0.98, seed=0):
+  '''
+  quantize each module group alone and sample on calibration clip features from the same seed as fp32, 
+  return names of groups whose token agreement with fp32 is below tolerance, they are to be kept fp32
+  '''
+  reference = make_denoise_step(model, "cpu")
+  names = quantizable_modules(model)
+  skip = []
+  for name in names:
+    step = make_denoise_step(model, "int8_cpu", quantize_skip=[n for n in names if not n == name])
+    token_agreement, _ = check_parity(model.run_config, step, reference, image_clip, seed)
+    if token_agreement < tolerance:
+      skip.append(name)
+  return skip
+
+def make_denoise_step(model, graph=None, batch_size=None, quantize_skip=(), onnx_path=None):
+  '''
+  return step(x, image_clip) -> (vocab_out, feature_out) used in image-only caption sampling
+    x shape: [batch_size, max_length, in_channel]
+    image_clip shape: [batch_size, 1, clip_dim]
+  graph is one of the RunConfig.inference_graph choices, shapes and default onnx path are taken from model.run_config,
+  the onnxruntime graph is exported once per weights to onnx_path with their fingerprint (see onnx_export_path)
+  '''
+  run_config = model.run_config
+  batch_size = batch_size or run_config.batch_size
+  if graph is None:
+    def step(x, image_clip):
+      return model(x, image_clip, torch.zeros_like(image_clip), torch.ones(x.shape[:2], device=device), torch.tensor([1, 0], device=device).repeat(x.shape[0], 1))
+    return step
+
+  if graph in ["cpu", "int8_cpu"]:
+    cpu_model = quantize_model(model, quantize_skip) if graph == "int8_cpu" else copy.deepcopy(model).cpu()
+    static_model = cpu_model.inference_module()
+    def step(x, image_clip):
+      out, restored = static_model(x.cpu(), image_clip.cpu())
+      return out.to(x.device), restored.to(x.device)
+    return step
+
+  static_model = model.inference_module()
+  if graph == "static":
+    return static_model
+  if graph == "torchscript":
+    example = (torch.randn((batch_size, run_config.max_length, run_config.in_channel), device=device), torch.randn((batch_size, 1, 512), device=device))
+    with torch.no_grad():
+      return torch.jit.freeze(torch.jit.trace(static_model, example, check_trace=False))
+  if graph == "compile":
+    return torch.compile(static_model, dynamic=False)
+  if graph == "onnxruntime":
+    onnx_path = onnx_export_path(model, onnx_path or run_config.resolved_onnx_path())
+    if not os.path.exists(onnx_path):
+      export_onnx(model, onnx_path)
+    return OnnxDenoiseStep(onnx_path)
+  raise NotImplementedError(graph)
+
+def sample(config, step, image_clip, steps=5, clamp_index=None):
+  '''
+  iterative denoising from gaussian noise
+  input:
+    step: denoising step from make_denoise_step
+    image_clip shape: [batch_size, 1, clip_dim]
+    clamp_index: NearestEmbeddingIndex snapping x_0 prediction of every pass but the last onto token embeddings
+
+  return output of the last step
+    vocab_out, shape [batch_size, max_length, vocab_size]
+    feature_out, shape [batch_size, seq_len, in_channel]
+  '''
+  restored = torch.randn((image_clip.shape[0], config.max_length + 2, config.in_channel), device=device)
+  for i in range(steps):
+    x = restored[:, :config.max_length, :]
+    if clamp_index is not None and i > 0:
+      x = clamp_index.snap(x)
+    out, restored = step(x, image_clip)
+  return out, restored
+
+def sample_early_exit(config, step, image_clip, steps=None, clamp_index=None, patience=None, tolerance=None):
+  '''
+  iterative denoising as sample, but a sequence is retired from the active batch once its argmax tokens are unchanged and 
+  its relative feature change is below tolerance for patience consecutive passes, the remaining batch is compacted
+  NOTE: steps is the maximum number of passes, batch size shrinks between passes so "compile" graph recompiles per size
+
+  steps, patience and tolerance default to config sample_steps, early_exit_patience and early_exit_tolerance
+
+  return (vocab_out, feature_out) same as sample, and number of passes run for each sequence, shape [batch_size]
+  '''
+  steps = config.sample_steps if steps is None else steps
+  patience = config.early_exit_patience if patience is None else patience
+  tolerance = config.early_exit_tolerance if tolerance is None else tolerance
+  batch_size = image_clip.shape[0]
+  restored = torch.randn((batch_size, config.max_length + 2, config.in_channel), device=device)
+  active = torch.arange(batch_size, device=device) # index of active sequences in the batch
+  passes = torch.zeros(batch_size, dtype=torch.int64, device=device)
+  stable = torch.zeros(batch_size, dtype=torch.int64, device=device)
+  final_out = final_restored = prev_tokens = prev_feature = None
+  for i in range(steps):
+    x = restored[:, :config.max_length, :]
+    if clamp_index is not None and i > 0:
+      x = clamp_index.snap(x)
+    out, restored = step(x, image_clip[active])
+    passes[active] += 1
+    if final_out is None:
+      final_out = out.new_empty((batch_size, *out.shape[1:]))
+      final_restored = restored.new_empty((batch_size, *restored.shape[1:]))
+
+    tokens = out.argmax(dim=-1)
+    feature = restored[:, :config.max_length, :]
+    if prev_tokens is not None:
+      delta = (feature - prev_feature).norm(dim=-1).mean(dim=-1) / prev_feature.norm(dim=-1).mean(dim=-1)
+      unchanged = (tokens == prev_tokens).all(dim=-1) & (delta < tolerance)
+      stable[active] = torch.where(unchanged, stable[active] + 1, torch.zeros_like(stable[active]))
+
+    if i == steps - 1:
+      done = torch.ones(len(active), dtype=torch.bool, device=device)
+    else:
+      done = stable[active] >= patience
+    final_out[active[done]] = out[done]
+    final_restored[active[done]] = restored[done]
+
+    # compact batch to sequences still changing
+    keep = ~done
+    active = active[keep]
+    if len(active) == 0:
+      break
+    restored = restored[keep]
+    prev_tokens = tokens[keep]
+    # clone as some steps return reused output buffers
+    prev_feature = feature[keep].clone()
+  return final_out, final_restored, passes
+
+def check_parity(config, step, reference_step, image_clip, seed=0, steps=5):
+  '''
+  sample with both steps from the same seed, return (fraction of identical argmax tokens, max abs vocab_out difference)
+  '''
+  with torch.no_grad():
+    torch.manual_seed(seed)
+    out = sample(config, step, image_clip, steps)[0].clone()
+    torch.manual_seed(seed)
+    reference_out, _ = sample(config, reference_step, image_clip, steps)
+  return (out.argmax(dim=-1) == reference_out.argmax(dim=-1)).float().mean().item(), (out - reference_out).abs().max().item()
+
+def benchmark_denoise_step(config, step, batch_size=None, warmup=5, repeat=50):
+  '''
+  return average seconds per denoising step on random fixed shape input
+  '''
+  batch_size = batch_size or config.batch_size
+  x = torch.randn((batch_size, config.max_length, config.in_channel), device=device)
+  image_clip = torch.randn((batch_size, 1, 512), device=device)
+  with torch.no_grad():
+    for _ in range(warmup):
+      step(x, image_clip)
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+      step(x, image_clip)
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+  return (time.perf_counter() - start) / repeat
+
+class ClipCaptionScorer():
+  '''
+  cosine similarity between CLIP image feature and CLIP text feature of decoded captions, 
+  text features are computed by extract.text_features (CLIP loaded once per process by extract.load_clip),
+  cached by caption string and only unseen captions are encoded. The cache keeps the cache_size most recently used captions
+  '''
+  def __init__(self, config, cache_size=4096) -> None:
+    from .extract import load_clip
+
+    self.config = config
+    load_clip(config.clip_processor_path, config.clip_path)
+    self.cache = collections.OrderedDict()
+    self.cache_size = cache_size
+
+  def text_features(self, captions):
+    from .extract import text_features
+
+    features = {caption: self.cache[caption] for caption in dict.fromkeys(captions) if caption in self.cache}
+    new_captions = [caption for caption in dict.fromkeys(captions) if caption not in features]
+    if len(new_captions) > 0:
+      features.update(zip(new_captions, text_features(self.config, new_captions)))
+    for caption, feature in features.items():
+      self.cache[caption] = feature
+      self.cache.move_to_end(caption)
+    while len(self.cache) > self.cache_size:
+      self.cache.popitem(last=False)
+    return torch.stack([features[caption] for caption in captions])
+
+  def __call__(self, captions, image_clip):
+    '''
+    input:
+      captions: list of candidate_num strings
+      image_clip shape: [candidate_num, clip_dim]
+
+    return score shape [candidate_num]
+    '''
+    return (self.text_features(captions) * nn.functional.normalize(image_clip, dim=-1)).sum(dim=-1)
+
+def rerank_candidates(indexes, image_clip, scorer, candidate_num, tokenizer):
+  '''
+  input:
+    indexes: decoded tokenizer ids, candidates of the same image are adjacent, shape [batch_size * candidate_num, max_length]
+    image_clip shape: [batch_size * candidate_num, 1, clip_dim]
+  
+  return ids of the highest scoring candidate of each image, shape [batch_size, max_length]
+  '''
+  captions = tokenizer.batch_decode(indexes, skip_special_tokens=True)
+  scores = scorer(captions, image_clip[:, 0, :]).reshape((-1, candidate_num))
+  indexes = indexes.reshape((scores.shape[0], candidate_num, -1))
+  return indexes[torch.arange(scores.shape[0], device=indexes.device), scores.argmax(dim=-1)]
@@ -0,0 +1,158 @@
+'''
+sharded caption datasets for corpora larger than memory: fixed size shards of aligned CLIP features and pre-tokenized captions,
+streamed by ShardedCLIPDataset with worker-aware shard assignment, a shuffle buffer and read-ahead of the next shard,
+so loader memory depends on shard and buffer size only, not on corpus size
+
+layout of a shard directory, written by the pack command:
+  index.json        {"version", "tokenizer", "max_length", "clip_dim", "length", "sources": [DataSource fields, "start", "length"],
+                     "shards": [{"file", "length", "source"}, ...]}, see utils.manifest_directory
+  shard-00000.npz   image, text: [n, clip_dim] float16 CLIP features
+                    input_ids: [n, max_length] int32 padded token ids, lengths: [n] int16 non-padding tokens
+                    captions, image_names: [n] str
+'''
+
+import concurrent.futures
+import json
+import os
+import random
+
+import numpy as np
+import torch
+
+SHARD_VERSION = 1
+
+def tokenizer_name(config):
+  '''
+  identifies the tokenizer of config in index.json, shards only feed runs tokenizing the same way
+  '''
+  if config.train_embedding:
+    return f"dict:{config.vocab_captions}:{config.vocab_min_count}"
+  return config.tokenizer_path
+
+def read_index(path):
+  '''
+  index.json of shard directory path
+  '''
+  index_path = os.path.join(path, "index.json")
+  if not os.path.exists(index_path):
+    raise FileNotFoundError(f"{index_path} missing, {path} is not a shard directory or its packing was interrupted")
+  with open(index_path) as f:
+    index = json.load(f)
+  if not index["version"] == SHARD_VERSION:
+    raise ValueError(f"{path} has shard version {index['version']}, expected {SHARD_VERSION}")
+  return index
+
+def load_shard(path, file):
+  '''
+  dict of the arrays of one shard, read fully, a shard is small against the corpus
+  '''
+  with np.load(os.path.join(path, file)) as shard:
+    return {key: shard[key] for key in shard.files}
+
+class ShardedCLIPDataset(torch.utils.data.IterableDataset):
+  '''
+  streams the caption rows of shards (file names, default every shard of the directory) as FlickrCLIPDataset items on CPU.
+  Each loader worker reads its own shards: shard order is shuffled per epoch with seed, then split round robin between workers.
+  When shuffle, rows pass through a buffer of buffer_size rows and are drawn from it at random.
+  batch_size and num_workers are those of the DataLoader, they make len(DataLoader) its number of batches with drop_last
+  NOTE: DataLoader workers get a copy of the dataset, call set_epoch before iterating and do not use persistent_workers
+  '''
+  def __init__(self, path, shards=None, shuffle=True, buffer_size=4096, seed=0, batch_size=None, num_workers=0) -> None:
+    self.path = path
+    self.index = read_index(path)
+    self.shards = self.index["shards"] if shards is None else [shard for shard in self.index["shards"] if shard["file"] in set(shards)]
+    self.shuffle = shuffle
+    self.buffer_size = buffer_size
+    self.seed = seed
+    self.batch_size = batch_size
+    self.num_workers = num_workers
+    self.epoch = 0
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def __len__(self):
+    '''
+    rows of this epoch, with batch_size only the rows in full batches, as each worker batches its own shards and drops its incomplete last batch
+    '''
+    if self.batch_size is None:
+      return sum(shard["length"] for shard in self.shards)
+    lengths = {shard["file"]: shard["length"] for shard in self.shards}
+    num_workers = max(self.num_workers, 1)
+    return sum(sum(lengths[file] for file in self.shard_files(worker_id, num_workers)) // self.batch_size * self.batch_size for worker_id in range(num_workers))
+
+  def shard_files(self, worker_id=0, num_workers=1):
+    '''
+    shard files read by loader worker worker_id of num_workers in this epoch
+    '''
+    files = [shard["file"] for shard in self.shards]
+    if self.shuffle:
+      random.Random(self.seed * 1000003 + self.epoch).shuffle(files)
+    return files[worker_id::num_workers]
+
+  def worker_shards(self):
+    '''
+    shard files read by the calling loader worker (or the main process without workers)
+    '''
+    worker = torch.utils.data.get_worker_info()
+    if worker is None:
+      return self.shard_files()
+    return self.shard_files(worker.id, worker.num_workers)
+
+  def rows(self):
+    '''
+    yield (shard arrays, row) over the worker shards, the next shard is read in background while the current one is consumed
+    '''
+    files = self.worker_shards()
+    if len(files) == 0:
+      return
+    with concurrent.futures.ThreadPoolExecutor(1) as reader:
+      pending = reader.submit(load_shard, self.path, files[0])
+      for i in range(len(files)):
+        shard = pending.result()
+        if i + 1 < len(files):
+          pending = reader.submit(load_shard, self.path, files[i + 1])
+        for row in range(len(shard["lengths"])):
+          yield shard, row
+
+  def item(self, shard, row):
+    input_ids = torch.from_numpy(shard["input_ids"][row].astype(np.int64))
+    return {
+      "image_clip": torch.from_numpy(shard["image"][row].astype(np.float32)),
+      "text_clip": torch.from_numpy(shard["text"][row].astype(np.float32)),
+      "input_ids": input_ids,
+      "attention_mask": (torch.arange(len(input_ids)) < int(shard["lengths"][row])).long(),
+      "text": str(shard["captions"][row]),
+      "image": str(shard["image_names"][row]),
+    }
+
+  def __iter__(self):
+    if not self.shuffle:
+      for shard, row in self.rows():
+        yield self.item(shard, row)
+      return
+    worker = torch.utils.data.get_worker_info()
+    rng = random.Random((self.seed * 1000003 + self.epoch) * 1009 + (0 if worker is None else worker.id))
+    buffer = []
+    for shard, row in self.rows():
+      # items are copies, buffered rows do not keep their shard in memory
+      item = self.item(shard, row)
+      if len(buffer) < self.buffer_size:
+        buffer.append(item)
+        continue
+      i = rng.randrange(len(buffer))
+      yield buffer[i]
+      buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+  def token_ids(self):
+    '''
+    sorted token ids occurring in the shards, read one shard at a time
+    '''
+    ids = set()
+    for shard in self.shards:
+      arrays = load_shard(self.path, shard["file"])
+      mask = np.arange(arrays["input_ids"].shape[1]) < arrays["lengths"][:, None]
+      ids.update(np.unique(arrays["input_ids"][mask]).tolist())
+    return sorted(ids)
@@ -0,0 +1,84 @@
+'''
+split manifests: train and validation row indices of a caption dataset as int32 arrays with a versioned manifest of the dataset fingerprint,
+memory-mapped on load. A split is computed once per dataset, train_set_ratio, split kind and seed under split_dir and shared by every trial,
+each run records the split it trained on as {model_name}.split in output_dir
+
+layout of a split directory:
+  manifest.json          {"version", "fingerprint", "length", "train_set_ratio", "by_image", "seed", "train", "val"}, see utils.manifest_directory
+  train.npy, val.npy     sorted int32 row indices
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .utils import atomic_write, manifest_directory
+
+SPLIT_VERSION = 1
+
+def dataset_fingerprint(dataset):
+  '''
+  sha1 over the image name and caption of every row of dataset, in order
+  '''
+  rows = pd.util.hash_pandas_object(dataset.data[["image", "caption"]], index=False)
+  return hashlib.sha1(rows.to_numpy().tobytes()).hexdigest()
+
+def compute_split(dataset, train_set_ratio, by_image=False, seed=0):
+  '''
+  return (train, val) sorted int32 row indices of a seeded random split of the rows of dataset,
+  or of its images when by_image, so no validation image has captions in the training split
+  '''
+  rng = np.random.default_rng(seed)
+  if not by_image:
+    order = rng.permutation(len(dataset))
+    train_len = int(len(dataset) * train_set_ratio)
+    return np.sort(order[:train_len]).astype(np.int32), np.sort(order[train_len:]).astype(np.int32)
+  image_codes, image_names = pd.factorize(dataset.data["image"])
+  train_images = np.zeros(len(image_names), dtype=bool)
+  train_images[rng.permutation(len(image_names))[:int(len(image_names) * train_set_ratio)]] = True
+  train_rows = train_images[image_codes]
+  return np.flatnonzero(train_rows).astype(np.int32), np.flatnonzero(~train_rows).astype(np.int32)
+
+def save_split(path, train, val, fingerprint, length, train_set_ratio, by_image, seed):
+  '''
+  write split directory path, arrays are renamed into place so readers mapping a previous split keep their files
+  '''
+  with manifest_directory(path, "manifest.json") as manifest:
+    for name, indices in [("train", train), ("val", val)]:
+      with atomic_write(os.path.join(path, f"{name}.npy")) as f:
+        np.save(f, np.asarray(indices, dtype=np.int32))
+    manifest.update({
+      "version": SPLIT_VERSION, "fingerprint": fingerprint, "length": length,
+      "train_set_ratio": train_set_ratio, "by_image": by_image, "seed": seed, "train": len(train), "val": len(val),
+    })
+
+def load_split(path, fingerprint=None):
+  '''
+  return (train, val) read-only memory-mapped int32 row indices of split directory path,
+  raise ValueError if the split is of another version or, when fingerprint is given, of another dataset
+  '''
+  with open(os.path.join(path, "manifest.json")) as f:
+    manifest = json.load(f)
+  if not manifest["version"] == SPLIT_VERSION:
+    raise ValueError(f"{path} has split version {manifest['version']}, expected {SPLIT_VERSION}")
+  if fingerprint is not None and not manifest["fingerprint"] == fingerprint:
+    raise ValueError(f"{path} splits a dataset with fingerprint {manifest['fingerprint']}, not the loaded one ({fingerprint})")
+  return np.load(os.path.join(path, "train.npy"), mmap_mode="r"), np.load(os.path.join(path, "val.npy"), mmap_mode="r")
+
+def shared_split_path(config, fingerprint):
+  return os.path.join(config.split_dir, f"{fingerprint[:12]}_ratio{config.train_set_ratio}_{'image' if config.split_by_image else 'row'}_seed{config.split_seed}")
+
+def shared_split(config, dataset):
+  '''
+  return (train, val) row indices of the split of dataset configured by config, loaded from split_dir, computed and saved there on first use
+  '''
+  fingerprint = dataset_fingerprint(dataset)
+  path = shared_split_path(config, fingerprint)
+  if not os.path.exists(os.path.join(path, "manifest.json")):
+    train, val = compute_split(dataset, config.train_set_ratio, config.split_by_image, config.split_seed)
+    save_split(path, train, val, fingerprint, len(dataset), config.train_set_ratio, config.split_by_image, config.split_seed)
+    print(f"split of {len(dataset)} rows into {len(train)} train and {len(val)} validation rows saved to {path}")
+  return load_split(path, fingerprint)
@@ -0,0 +1,461 @@
+'''
+train command: fits CLIP-DiffusionLM on the CLIP features of the configured caption datasets,
+the model, train / validation split manifest and run config are saved to {model_name}.pickle, .split and .json in output_dir
+'''
+
+import argparse
+import concurrent.futures
+import copy
+import math
+import multiprocessing
+import time
+
+import torch
+from torch import nn, optim
+
+from . import data
+from .config import add_config_arguments, config_from_args
+from .diffusion import diffuse_t, generate_diffuse_pair, loss, noise_bank, stratified_timesteps
+from .ema import ExponentialMovingAverage
+from .model import build_model, load_checkpoint
+from .optimizer import benchmark_optimizers, build_optimizer
+from .utils import get_device, mem_report
+
+device = get_device()
+
+def cosine_annealing(config, steps_per_epoch=1):
+  '''
+  cosine decay from learning_rate to end_learning_rate restarting every 5 epochs, 3 restarts, value of each of steps_per_epoch steps in an epoch
+  '''
+  sub_epoch = 5 * steps_per_epoch
+  x = torch.arange(0, sub_epoch)
+  x = config.end_learning_rate + (config.learning_rate - config.end_learning_rate) * (1 + torch.cos(x / sub_epoch * math.pi)) / 2
+  return x.repeat((3, ))
+
+def learning_rates(config):
+  '''
+  learning rate of each epoch
+  '''
+  if config.scheduler == "linspace":
+    return torch.linspace(config.learning_rate, config.end_learning_rate, config.epoch_num)
+  elif config.scheduler == "logspace":
+    return torch.logspace(torch.tensor([config.learning_rate]).log10().item(), torch.tensor([config.end_learning_rate]).log10().item(), config.epoch_num)
+  elif config.scheduler == "cosine_annealing":
+    return cosine_annealing(config)
+  raise NotImplementedError(config.scheduler)
+
+def step_learning_rates(config, steps_per_epoch):
+  '''
+  learning rate of each optimizer step: the epoch's learning_rates value, or the scheduler evaluated per step when scheduler_per_step,
+  ramped linearly from 0 over the first warmup_steps steps
+  '''
+  step_num = config.epoch_num * steps_per_epoch
+  if not config.scheduler_per_step:
+    lrs = learning_rates(config)[:config.epoch_num].repeat_interleave(steps_per_epoch)
+  elif config.scheduler == "cosine_annealing":
+    lrs = cosine_annealing(config, steps_per_epoch)[:step_num]
+  else:
+    lrs = learning_rates(config.replace(epoch_num=step_num))
+  warmup_steps = min(config.warmup_steps, len(lrs))
+  lrs[:warmup_steps] *= torch.arange(1, warmup_steps + 1) / warmup_steps
+  return lrs
+
+def train_func(config, model, trainer, x, train=True, rounding_weight=None, zero_grad=True, step=True, loss_scale=1, t=None, noise=None, generator=None):
+  '''
+  losses of batch x, when train, backward of the total loss times loss_scale,
+  gradients are cleared before unless zero_grad is False and trainer steps after unless step is False, for gradient accumulation
+  t, noise and generator fix the random inputs for deterministic validation, they are drawn freshly by default
+    t shape: [sample_size, 1, 1]
+    noise: noise of x_t, x_1 and x_tgt, shape [3, batch_size, seq_len, in_channel]
+    generator: CPU torch.Generator of the classifier free guidance mask
+  '''
+  # batches streamed from shards arrive on CPU
+  x = {key: value.to(device, non_blocking=True) if torch.is_tensor(value) else value for key, value in x.items()}
+  if "x_0" in x:
+    # cached x_0 is pre-dropout embedding output, apply the embedding dropout as model.embedding would
+    x_0 = nn.functional.dropout(x["x_0"], p=model.embedding.dropout.p, training=model.training)
+  else:
+    x_0 = model.embedding(x["input_ids"])
+  repeat_shape = (config.sample_size, *(1, ) * (len(x_0.shape) - 1))
+  if t is None:
+    t = torch.randint(0, config.step_tot, repeat_shape, device=device)
+  noise_t, noise_1, noise_tgt = (None, None, None) if noise is None else noise
+
+  if config.x_0_prediction:
+    x_t = diffuse_t(config, x_0, t, noise_t)
+    x_tgt = None
+  else:
+    x_t, x_tgt = generate_diffuse_pair(config, x_0, t, torch.max(t - config.x_t_step_interval, torch.zeros(t.shape, device=device, dtype=torch.int64)), noise_t, noise_tgt)
+  x_1 = diffuse_t(config, x_0, torch.ones(1, dtype=torch.int64, device=device), noise_1)
+
+  if train and zero_grad:
+    trainer.zero_grad()
+  x_t_loss, x_1_loss, prob_loss = loss(
+    config, model,
+    x_t, x_1, x_tgt, x_0,
+    x["image_clip"], x["text_clip"],
+    x["attention_mask"],
+    x["input_ids"],
+    rounding_weight,
+    generator
+  )
+
+  l = x_t_loss + x_1_loss + prob_loss
+  if train:
+    (l * loss_scale).backward()
+    if step:
+      trainer.step()
+
+  return l, x_t_loss, x_1_loss, prob_loss
+
+def validation_inputs(config, batch_num, batch_size, seq_len):
+  '''
+  return (t, noise) of validation batch batch_num for train_func: the stratified timestep grid of sample_size steps, 
+  and noise of the batch rows from the seeded noise bank, rows cycle through the bank in loader order
+  '''
+  t = stratified_timesteps(config.sample_size, config.step_tot).reshape((-1, 1, 1))
+  bank = noise_bank(config.val_noise_bank_size, config.max_length, config.in_channel, config.val_noise_seed)
+  rows = torch.arange(batch_num * batch_size, (batch_num + 1) * batch_size, device=device) % len(bank)
+  return t, bank[rows, :, :seq_len, :].transpose(0, 1)
+
+def validate(config, model, trainer, val_loader, rounding_weight=None):
+  '''
+  average validation losses over val_loader, the probability loss weighted by rounding_weight as in training (default config.rounding_weight)
+  '''
+  val_acc_x_t = 0
+  val_acc_x_1 = 0
+  val_acc_prob = 0
+  model.eval()
+  t = noise = generator = None
+  if config.deterministic_validation:
+    generator = torch.Generator().manual_seed(config.val_noise_seed)
+  with torch.no_grad():
+    for batch_num, x in enumerate(val_loader):
+      if config.deterministic_validation:
+        t, noise = validation_inputs(config, batch_num, *x["input_ids"].shape)
+      _, x_t_loss, x_1_loss, prob_loss = train_func(config, model, trainer, x, train=False, rounding_weight=rounding_weight, t=t, noise=noise, generator=generator)
+      val_acc_x_t += x_t_loss
+      val_acc_x_1 += x_1_loss
+      val_acc_prob += prob_loss
+  model.train()
+
+  return val_acc_x_t / len(val_loader), val_acc_x_1 / len(val_loader), val_acc_prob / len(val_loader),
+
+def validation_config(config):
+  '''
+  config validation losses are computed with, val_sample_size timesteps per caption
+  '''
+  return config.replace(sample_size=config.val_sample_size or config.sample_size)
+
+def snapshot(model):
+  '''
+  copy of model weights, without gradients
+  '''
+  grads = {p: p.grad for p in model.parameters()}
+  for p in grads:
+    p.grad = None
+  copied = copy.deepcopy(model)
+  for p, grad in grads.items():
+    p.grad = grad
+  return copied
+
+def validate_snapshot(config, model, val_loader, rounding_weight=None, producer=None):
+  '''
+  validation losses of a snapshot as floats, on a side CUDA stream so the training stream is not blocked,
+  producer is the CUDA stream the snapshot was copied on, default the current stream
+  '''
+  if device.type == "cuda":
+    side = torch.cuda.Stream()
+    # the snapshot copy queued on producer must complete before the side stream reads it,
+    # and its memory must not be reused by producer while the side stream still reads it
+    side.wait_stream(producer or torch.cuda.current_stream())
+    for tensor in model.state_dict().values():
+      tensor.record_stream(side)
+    with torch.cuda.stream(side):
+      # float() waits for the side stream only
+      return tuple(float(l) for l in validate(config, model, None, val_loader, rounding_weight))
+  return tuple(float(l) for l in validate(config, model, None, val_loader, rounding_weight))
+
+def validate_in_worker(config, model, val_indices, rounding_weight=None):
+  '''
+  validation losses of a CPU snapshot in a worker process, the dataset is loaded once per worker,
+  val_indices are validation shard files when config.shard_dir is set
+  '''
+  model = model.to(device)
+  if config.shard_dir is not None:
+    return validate_snapshot(config, model, data.make_loader(config, None, val_indices, shuffle=False), rounding_weight)
+  dataset = data.load_dataset(config)
+  if config.cache_x_0 and not config.train_embedding:
+    dataset.x_0_cache = data.load_x_0_cache(config.resolved_x_0_cache_path(), model.embedding, dataset)
+  val_loader = data.make_loader(config, dataset, torch.utils.data.Subset(dataset, val_indices), shuffle=False)
+  return validate_snapshot(config, model, val_loader, rounding_weight)
+
+class AsyncValidator():
+  '''
+  validates weight snapshots in a background thread or worker process while training continues.
+  At most one validation is pending, submit waits for the previous one and returns its result
+  '''
+  def __init__(self, config, dataset, val_set) -> None:
+    self.config = validation_config(config)
+    self.mode = config.async_validation
+    self.pending = None # (epoch, snapshot, train losses, future)
+    if self.mode == "thread":
+      self.executor = concurrent.futures.ThreadPoolExecutor(1)
+      self.val_loader = data.make_loader(self.config, dataset, val_set, shuffle=False)
+    elif self.mode == "process":
+      # spawn, as forked workers cannot reinitialize CUDA
+      self.executor = concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"))
+      self.val_indices = val_set if dataset is None else list(val_set.indices)
+    else:
+      raise NotImplementedError(self.mode)
+
+  def submit(self, model, epoch, train_losses, rounding_weight=None):
+    '''
+    start validating a snapshot of model with the current rounding_weight of training,
+    return results finished so far as list of (epoch, snapshot, train losses, val losses)
+    '''
+    results = self.wait()
+    model_snapshot = snapshot(model).eval()
+    # dynamic rounding weight is a tensor of the training graph, validation gets its value
+    rounding_weight = None if rounding_weight is None else float(rounding_weight)
+    if self.mode == "thread":
+      producer = torch.cuda.current_stream() if device.type == "cuda" else None
+      future = self.executor.submit(validate_snapshot, self.config, model_snapshot, self.val_loader, rounding_weight, producer)
+    else:
+      model_snapshot = model_snapshot.cpu()
+      future = self.executor.submit(validate_in_worker, self.config, model_snapshot, self.val_indices, rounding_weight)
+    self.pending = (epoch, model_snapshot, train_losses, future)
+    return results
+
+  def wait(self):
+    if self.pending is None:
+      return []
+    epoch, model_snapshot, train_losses, future = self.pending
+    self.pending = None
+    return [(epoch, model_snapshot, train_losses, future.result())]
+
+  def close(self):
+    results = self.wait()
+    self.executor.shutdown()
+    return results
+
+def save_checkpoint(model, path):
+  '''
+  pickle model on CPU, model is moved back to its device
+  '''
+  model_device = next(iter(model.parameters())).device
+  torch.save(model.cpu(), path)
+  model.to(model_device)
+
+def record_validation(config, summary, epoch, model, train_losses, val_losses, early_stopped):
+  '''
+  log losses of epoch, at the first epoch whose validation loss exceeds early_stop_ratio times training loss
+  the validated model is saved, return early_stopped
+  '''
+  # losses of synchronous validation are tensors, with the autograd graph for training losses
+  train_losses = tuple(float(l) for l in train_losses)
+  val_losses = tuple(float(l) for l in val_losses)
+  if sum(val_losses) > config.early_stop_ratio * sum(train_losses):
+    if not early_stopped:
+      summary.write("early stop! \n")
+      save_checkpoint(model, config.path(".pickle"))
+    early_stopped = True
+  summary.write(f"epoch {epoch} average x_t_loss, x_1_loss, prob_loss, val losses: {', '.join(str(l) for l in train_losses + val_losses)}\n")
+  summary.flush()
+  return early_stopped
+
+def benchmark_gradient_checkpointing(config, model, dataset, subset, repeat=5, max_multiple=8):
+  '''
+  return report lines of training step time, samples/sec and peak activation memory at batch_size with and without gradient checkpointing,
+  and on CUDA the largest batch size (batch_size times a power of 2 up to max_multiple) fitting in memory in each mode
+  NOTE: the benchmark optimizer has learning rate 0, weights are unchanged
+  '''
+  trainer = optim.AdamW(model.parameters(), lr=0)
+
+  def timed_steps(batch_size, steps):
+    # loss shapes are checked against the config batch size
+    probe_config = config.replace(batch_size=batch_size)
+    x = next(iter(data.make_loader(probe_config, dataset, subset, shuffle=True)))
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+      torch.cuda.reset_peak_memory_stats()
+      base_memory = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(steps):
+      train_func(probe_config, model, trainer, x)
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+      return (time.perf_counter() - start) / steps, (torch.cuda.max_memory_allocated() - base_memory) / 2 ** 20
+    return (time.perf_counter() - start) / steps, None
+
+  lines = []
+  model.train()
+  for enabled in [False, True]:
+    model.set_gradient_checkpointing(enabled)
+    timed_steps(config.batch_size, 1) # warmup
+    step_time, peak_memory = timed_steps(config.batch_size, repeat)
+    line = f"gradient checkpointing {enabled}: {step_time * 1000:.1f} ms per step, {config.batch_size * config.sample_size / step_time:.1f} samples/sec, batch size {config.batch_size}"
+    if peak_memory is not None:
+      fitting = config.batch_size
+      multiple = 2
+      while multiple <= max_multiple:
+        try:
+          timed_steps(config.batch_size * multiple, 1)
+        except torch.cuda.OutOfMemoryError:
+          trainer.zero_grad(set_to_none=True)
+          torch.cuda.empty_cache()
+          break
+        fitting = config.batch_size * multiple
+        multiple *= 2
+      line += f", peak activation memory {peak_memory:.0f} MB, largest fitting batch size {fitting}{'+' if multiple > max_multiple else ''}"
+    lines.append(line + "\n")
+  model.set_gradient_checkpointing(config.gradient_checkpointing)
+  trainer.zero_grad()
+  return lines
+
+def run(config):
+  '''
+  train a model with config, return it
+  '''
+  print(f"trial name: {config.model_name}")
+  mem_report()
+
+  tokenizer = data.load_tokenizer(config)
+  if config.shard_dir is None:
+    dataset = data.load_dataset(config)
+    train_set, val_set = data.split_dataset(config, dataset)
+  else:
+    # streamed from shards, train_set and val_set are lists of shard files
+    assert not config.cache_x_0 or config.train_embedding, "x_0 cache is indexed by dataset row, not supported when streaming shards"
+    dataset = None
+    train_set, val_set = data.split_shards(config)
+  train_loader = data.make_loader(config, dataset, train_set, shuffle=True)
+  val_loader = data.make_loader(config, dataset, val_set, shuffle=False)
+  mem_report()
+
+  model = build_model(config, data.vocab_size(tokenizer))
+  if config.restrict_vocab and not config.train_embedding:
+    if dataset is None:
+      sub_vocab = data.build_shard_sub_vocab(config, train_set, tokenizer)
+    else:
+      sub_vocab = data.build_sub_vocab(dataset, train_set.indices)
+    model.restrict_vocab(sub_vocab, tokenizer.unk_token_id)
+    print(f"lm_head restricted to {len(model.sub_vocab)} of {data.vocab_size(tokenizer)} tokens")
+
+  if config.cache_x_0 and not config.train_embedding:
+    dataset.x_0_cache = data.load_x_0_cache(config.resolved_x_0_cache_path(), model.embedding, dataset)
+
+  # parameter only include model, no embedding layer
+  # trainer = optim.Adam(model.parameters(), lr=LEARNING_RATE)
+  trainer = build_optimizer(config, model)
+  mem_report()
+
+  if config.continue_train:
+    model = load_checkpoint(config)
+    # model.model.add_module("activation", activations.GELUActivation())
+    trainer = build_optimizer(config, model)
+    if dataset is not None and dataset.x_0_cache is not None:
+      # checkpoint embedding must match the one cache was built from
+      dataset.x_0_cache = data.load_x_0_cache(config.resolved_x_0_cache_path(), model.embedding, dataset)
+  if config.ema_decay > 0 and getattr(model, "ema", None) is None:
+    model.ema = ExponentialMovingAverage(model, config.ema_decay, config.ema_on_host, config.ema_update_interval)
+  ema = getattr(model, "ema", None)
+  config.save()
+  if dataset is not None:
+    # evaluation and continue_train run on the same split, a shard split is recomputed from shard_dir
+    data.save_run_split(config, dataset, train_set, val_set)
+  summary = open(config.path(".txt"), "a")
+  # summary = sys.stdout
+
+  model.set_gradient_checkpointing(config.gradient_checkpointing)
+  if config.benchmark_gradient_checkpointing:
+    summary.writelines(benchmark_gradient_checkpointing(config, model, dataset, train_set))
+  if config.benchmark_optimizer:
+    summary.writelines(benchmark_optimizers(config, model))
+
+  # debug trains one batch per epoch, the last optimizer step of an epoch may accumulate fewer batches
+  steps_per_epoch = math.ceil((1 if config.debug else len(train_loader)) / config.accumulation_steps)
+  lrs = step_learning_rates(config, steps_per_epoch)
+
+  validator = None if config.async_validation is None else AsyncValidator(config, dataset, val_set)
+  rounding_weight = config.rounding_weight
+  early_stopped = False
+  model.train()
+  print("start training")
+  for epoch in range(config.epoch_num):
+    acc_x_t = 0
+    acc_x_1 = 0
+    acc_prob = 0
+    if dataset is None:
+      # reshuffles shard order, loader workers copy the dataset at each epoch
+      train_loader.dataset.set_epoch(epoch)
+    # streamed epochs differ slightly in length, as shards are dealt to the loader workers anew
+    batch_num_per_epoch = 1 if config.debug else len(train_loader)
+    batch_count = 0
+    stepped = True
+
+    # with tqdm.tqdm(train_loader, unit="batch") as tepoch:
+    #   for batch_num, x in enumerate(tepoch):
+    for batch_num, x in enumerate(train_loader):
+        if batch_num >= batch_num_per_epoch:
+          break
+        # batches group_start .. group_start + group_size - 1 are accumulated into one optimizer step
+        group_start = batch_num - batch_num % config.accumulation_steps
+        group_size = min(config.accumulation_steps, batch_num_per_epoch - group_start)
+        if batch_num == group_start:
+          for g in trainer.param_groups:
+            g['lr'] = lrs[min(epoch * steps_per_epoch + batch_num // config.accumulation_steps, (epoch + 1) * steps_per_epoch - 1)].item()
+
+        stepped = batch_num == group_start + group_size - 1
+        _, x_t_loss, x_1_loss, prob_loss = train_func(
+          config, model, trainer, x, rounding_weight=rounding_weight,
+          zero_grad=batch_num == group_start, step=stepped, loss_scale=1 / group_size)
+        if ema is not None and stepped:
+          ema.update(model)
+        batch_count += 1
+
+        acc_x_t += x_t_loss
+        acc_x_1 += x_1_loss
+        acc_prob += prob_loss
+
+        if config.dynamic_rounding_weight > 0:
+          rounding_weight = ((acc_x_t + acc_x_1) / acc_prob).detach() * config.dynamic_rounding_weight
+
+        # tepoch.set_description(f"batch {batch_num}")
+        # tepoch.set_postfix(
+        #                    x_t_hidden=x_t_loss.item(),
+        #                    x_1_loss=x_1_loss.item(),
+        #                    prob_loss=prob_loss.item(),
+        #                    tot_loss=l.item())
+
+    if not stepped:
+      # the loader ended inside an accumulation group, its gradients still make an optimizer step
+      trainer.step()
+      if ema is not None:
+        ema.update(model)
+    batch_count = max(batch_count, 1)
+    train_losses = (acc_x_t / batch_count, acc_x_1 / batch_count, acc_prob / batch_count)
+    if validator is None:
+      results = [(epoch, model, train_losses, validate(validation_config(config), model, trainer, val_loader, rounding_weight))]
+    else:
+      results = validator.submit(model, epoch, tuple(float(l) for l in train_losses), rounding_weight)
+    for result in results:
+      early_stopped = record_validation(config, summary, *result, early_stopped)
+
+    if config.debug:
+      break
+
+  if validator is not None:
+    for result in validator.close():
+      early_stopped = record_validation(config, summary, *result, early_stopped)
+  if not early_stopped:
+    save_checkpoint(model, config.path(".pickle"))
+  summary.close()
+
+  mem_report()
+  return model
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python -m clip_ddpm train", description=__doc__.strip())
+  add_config_arguments(parser)
+  run(config_from_args(parser.parse_args(argv)))
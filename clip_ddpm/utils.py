@@ -0,0 +1,100 @@
+'''
+device selection, memory report, weight fingerprints, atomic file writes and checkpoint loading shared by the commands
+'''
+
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import pickle
+
+import torch
+
+@functools.lru_cache(maxsize=None)
+def get_device():
+  if torch.cuda.is_available():
+    dev = "cuda:0"
+  else:
+    dev = "cpu"
+  print("using device: ", dev)
+  return torch.device(dev)
+
+def mem_report():
+  import humanize, psutil, GPUtil
+
+  print("CPU RAM Free: " + humanize.naturalsize( psutil.virtual_memory().available ))
+
+  GPUs = GPUtil.getGPUs()
+  for i, gpu in enumerate(GPUs):
+    print('GPU {:d} ... Mem Free: {:.0f}MB / {:.0f}MB | Utilization {:3.0f}%'.format(i, gpu.memoryFree, gpu.memoryTotal, gpu.memoryUtil*100))
+
+def state_dict_fingerprint(module, salt=""):
+  '''
+  sha1 hex digest of salt and the names and values of module.state_dict(), in name order
+  '''
+  h = hashlib.sha1(salt.encode())
+  for name, tensor in sorted(module.state_dict().items()):
+    h.update(name.encode())
+    h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+  return h.hexdigest()
+
+@contextlib.contextmanager
+def atomic_write(path, mode="wb"):
+  '''
+  file object writing a temporary file renamed to path when the block completes, readers of path never see a partial file
+  '''
+  temporary = f"{path}.{os.getpid()}.tmp"
+  try:
+    with open(temporary, mode) as f:
+      yield f
+    os.replace(temporary, path)
+  finally:
+    if os.path.exists(temporary):
+      os.remove(temporary)
+
+@contextlib.contextmanager
+def manifest_directory(path, manifest_name):
+  '''
+  yield the manifest dict of directory path, written to json file manifest_name when the block completes.
+  The manifest of a previous write is removed first and the new one is written last, files are written in the block,
+  so a directory without manifest is an interrupted write and is never read as complete
+  '''
+  os.makedirs(path, exist_ok=True)
+  manifest_path = os.path.join(path, manifest_name)
+  if os.path.exists(manifest_path):
+    os.remove(manifest_path)
+  manifest = {}
+  yield manifest
+  with atomic_write(manifest_path, "w") as f:
+    json.dump(manifest, f, indent=2)
+
+# classes pickled into checkpoints and .valset files by the single file CLIP-DDPM.py script, where they lived in __main__
+LEGACY_CLASSES = {
+  "DistilBertModel": "clip_ddpm.model",
+  "StaticInferenceModel": "clip_ddpm.model",
+  "FlickrCLIPDataset": "clip_ddpm.data",
+  "DictTokenizer": "clip_ddpm.data",
+}
+
+class LegacyUnpickler(pickle.Unpickler):
+  def find_class(self, module, name):
+    if module == "__main__" and name in LEGACY_CLASSES:
+      module = LEGACY_CLASSES[name]
+    return super().find_class(module, name)
+
+class legacy_pickle():
+  '''
+  pickle_module for torch.load resolving LEGACY_CLASSES
+  '''
+  Unpickler = LegacyUnpickler
+
+  @staticmethod
+  def load(file, **kwargs):
+    return LegacyUnpickler(file, **kwargs).load()
+
+def load(path, map_location=None):
+  '''
+  torch.load of a pickled model or dataset, also accepting files written by the single file script
+  '''
+  return torch.load(path, map_location=map_location, pickle_module=legacy_pickle)